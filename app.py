@@ -1,19 +1,41 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import uuid
 import time
-import s3fs
-from sharehousepy import SnowflakeConnection, Query
-import snowflake.connector
-import pydeck as pdk
-import streamlit_shortcuts
-from streamlit_extras.keyboard_text import key, load_key_css
-import plotly.graph_objects as go
-from helpers.misc import write_df_async, format_minutes, calculate_zoom_level, calculate_radius, format_speed, add_meta, human_format, calculate_distance, alt_format_minutes
+from helpers.misc import write_df_async, format_minutes, calculate_zoom_level, calculate_radius, add_meta, human_format, alt_format_minutes, keyboard_shortcuts
+from helpers import cache, shared, priority, overview, geo
+from helpers.dedup import apply_duplicates
+from helpers.extract import snowflake_runner, locates_sql, segments_sql, locates_frame, segments_frame, group_segments, fetch_locates_async, sync_locates, retry_locates, locates_failed
+from helpers.export import EXPORT_FORMATS, build_export, export_file_name, clear_exports
 
 
 # API Functions
+def _load_device(df, segment_df, stats: dict, shared=None, pending=None):
+    # Everything a freshly loaded device starts from, for every way of loading one
+    st.session_state['stats'] = stats
+    st.session_state['df'] = df
+    st.session_state['segment_df'] = segment_df
+    # holding the shared entry is what keeps the shared frames alive
+    st.session_state['shared'] = shared
+    st.session_state['pending_locates'] = pending
+    st.session_state['labels'] = {}
+    st.session_state['scores'] = None
+    st.session_state['overview'] = None
+    st.session_state['annotations'] = {}
+    st.session_state['selection_end'] = None
+    st.session_state['start'] = time.time()
+    st.session_state['meta_pending'] = False
+    st.session_state['version'] = 0
+    st.session_state['dedup'] = None
+    # dedup inputs start from the loaded parameters again
+    st.session_state['dedup_minutes'] = int(st.session_state['minutes'])
+    st.session_state['dedup_truncation'] = int(st.session_state['truncation'])
+    clear_exports()
+
 def start() -> bool:
+    import s3fs
+
     try:
         s3 = s3fs.S3FileSystem(
             key=st.secrets["aws"]["PUBLIC_KEY"],
@@ -23,234 +45,63 @@ def start() -> bool:
         # Specify the S3 path to your CSV file
         s3_path = f"s3://a6dev-mltraining/raw_input/{st.session_state['truncation']}/{st.session_state['minutes']}/{st.session_state['km_threshold']}/{st.session_state['device_id'].lower()}.csv"
 
-        # Read the CSV file directly from S3 into a pandas DataFrame
-        with s3.open(s3_path, 'rb') as f:
-            df = pd.read_csv(f)
+        # Read the CSV file through the local cache, S3 is only hit when the etag changed
+        f, version = cache.fetch(s3, s3_path)
+
+        # Another session with the same file loaded already has the frames we need
+        with f:
+            key = shared.device_key()
+            entry = shared.get(key, version)
+            if entry is None:
+                df = pd.read_csv(f, parse_dates=['timestamp', 'start_time', 'end_time'])
+                grouped_df = group_segments(df)
+                grouped_df = grouped_df.sort_values(by=['segment']).reset_index(drop=True)
+                entry = shared.put(key, version, df, grouped_df)
+        df = entry['df']
+        grouped_df = entry['segment_df']
   
-            max_segment = df['segment'].max()
-
-            grouped_df = df.groupby(['segment']).agg({
-                'id': 'count',  # Count total rows
-                'timestamp': 'min',
-                'start_lat': 'max',
-                'start_lon': 'max',
-                'start_time': 'max',
-                'end_lat': 'max',
-                'end_lon': 'max',
-                'end_time': 'max',
-                'locates': 'max',
-                'min_seen': 'max',
-                'coverage_percent': 'max',
-                'km_travelled': 'max',
-                'fraud': 'max',
-                'supply_id': pd.Series.nunique,
-                'has_742': 'max'
-            }).reset_index()
-
-
-            grouped_df = grouped_df.sort_values(by=['segment']).reset_index(drop=True)
-
-            null_fraud_row = grouped_df[grouped_df['fraud'].isnull()].head(1)
-
-            starting_segment = int(null_fraud_row['segment'].iloc[0])
-
-            annotated = max(0, max_segment - int(grouped_df['fraud'].isna().sum()))
-
-            total_dupes_sum = grouped_df['locates'].sum() - len(grouped_df)
-            
-            stats = {
-                'max_segment': max_segment,
-                'current_segment': starting_segment,
-                'annotated': annotated,
-                'duplicates': total_dupes_sum - len(df),
-                'locates': total_dupes_sum
-            }
-            st.session_state['stats'] = stats
-            st.session_state['df'] = df
-            st.session_state['segment_df'] = grouped_df
-            st.session_state['annotations'] = {}
-            st.session_state['start'] = time.time()
-            
-            return True
+        max_segment = df['segment'].max()
+
+        null_fraud_row = grouped_df[grouped_df['fraud'].isnull()].head(1)
+
+        # Fully labeled devices are opened for review, start them from the beginning
+        starting_segment = int(null_fraud_row['segment'].iloc[0]) if len(null_fraud_row) else int(grouped_df['segment'].min())
+
+        annotated = max(0, max_segment - int(grouped_df['fraud'].isna().sum()))
+
+        total_dupes_sum = grouped_df['locates'].sum() - len(grouped_df)
+        
+        stats = {
+            'max_segment': max_segment,
+            'current_segment': starting_segment,
+            'annotated': annotated,
+            'duplicates': total_dupes_sum,
+            'locates': total_dupes_sum + len(df)
+        }
+        _load_device(df, grouped_df, stats, shared=entry)
+        
+        return True
+    except FileNotFoundError as e:
+        print(f'no s3 file yet: {e}')
+        return False
     except Exception as e:
+        # Only a missing file may fall through to a fresh query, which would overwrite the labels in it
         print(f'error reading s3 file: {e}')
-        return False
+        st.error(f'error loading device: {e}')
+        return None
 
 def query(device_id: str, minutes: int, truncation: int, km_threshold: int) -> bool:
     
-    sf_con = SnowflakeConnection(
-        username=st.secrets["database"]["SF_USERNAME"], 
-        password=st.secrets["database"]["SF_PASSWORD"],
-        account=st.secrets["database"]["SF_ACCOUNT"],
-        database=st.secrets["database"]["SF_DATABASE"],
-        schema=st.secrets["database"]["SF_SCHEMA"],
-        warehouse_sm=st.secrets["database"]["SF_WAREHOUSE_LG"],
-        warehouse_lg=st.secrets["database"]["SF_WAREHOUSE_LG"],
-        geo_table=st.secrets["database"]["SF_GEO_TABLE"],
-        id_table=st.secrets["database"]["SF_ID_TABLE"],
-    )
-    q = Query(
-        query=f"""
-        with all_data as (
-            select 
-                lower(idfa) as id, 
-                timestamp,
-                latitude,
-                longitude,
-                supply_id,
-                md5_hex(concat(time_slice(timestamp, {minutes}, 'minute'), trunc(latitude, {truncation}), trunc(longitude, {truncation}))) as rh,
-                count(1) over (partition by rh) as dupes
-            from
-                singularity.public.h4_maid_clustered
-            where
-                (idfa like '{device_id[:3].lower()}%' or idfa like '{device_id[:3].upper()}%') and
-                lower(idfa) = '{device_id.lower()}'
-            union all
-            select 
-                lower(idfa) as id, 
-                timestamp,
-                latitude,
-                longitude,
-                supply_id,
-                md5_hex(concat(time_slice(timestamp, {minutes}, 'minute'), trunc(latitude, {truncation}), trunc(longitude, {truncation}))) as rh,
-                count(1) over (partition by rh) as dupes
-            from
-                singularity.public.locations_purge
-            where
-                (idfa like '{device_id[:3].lower()}%' or idfa like '{device_id[:3].upper()}%') and
-                lower(idfa) = '{device_id.lower()}'
-        ), filtered_data as (
-            select
-                id,
-                timestamp,
-                latitude,
-                longitude,
-                supply_id,
-                rh,
-                dupes - 1 as duplicates
-            from
-                all_data
-        ), enriched_data as (
-            select
-                id,
-                timestamp,
-                latitude,
-                longitude,
-                supply_id,
-                rh,
-                duplicates,
-                datediff('minutes', lag(timestamp) over (order by timestamp, latitude, longitude), timestamp) as min_since_last_locate,
-                haversine(latitude, longitude, lag(latitude) over (order by timestamp, latitude, longitude), lag(longitude) over (order by timestamp, latitude, longitude)) as km_since_last_locate
-            from
-                filtered_data
-        ), grouped_data as (
-            select
-                *,
-                sum(case when km_since_last_locate > {km_threshold} then 1 else 0 end) over (order by timestamp, latitude, longitude) as segment
-            from
-                enriched_data
-        ), twice_enriched as (
-            select
-                id,
-                timestamp,
-                latitude,
-                longitude,
-                supply_id,
-                segment,
-                first_value(latitude) over (partition by segment order by timestamp, latitude, longitude) as start_lat,
-                last_value(latitude) over (partition by segment order by timestamp, latitude, longitude) as end_lat,
-                first_value(longitude) over (partition by segment order by timestamp, latitude, longitude) as start_lon,
-                last_value(longitude) over (partition by segment order by timestamp, latitude, longitude) as end_lon,
-                first_value(timestamp) over (partition by segment order by timestamp, latitude, longitude) as start_time,
-                last_value(timestamp) over (partition by segment order by timestamp, latitude, longitude) as end_time,
-                sum(min_since_last_locate) over (partition by segment) as total_mins,
-                sum(km_since_last_locate) over (partition by segment) as total_kms,
-                first_value(km_since_last_locate) over (partition by segment order by timestamp, latitude, longitude) as km_since_last_segment,
-                first_value(min_since_last_locate) over (partition by segment order by timestamp, latitude, longitude) as min_since_last_segment,
-                sum(duplicates) over (partition by segment) as segment_duplicates,
-                count(distinct date_trunc('mins', timestamp)) over (partition by segment) as covered_segment_mins
-            from
-                grouped_data
-        )
-        select
-            id,
-            timestamp,
-            latitude,
-            longitude,
-            supply_id,
-            segment,
-            segment_duplicates as locates,
-            total_mins - min_since_last_segment as min_seen,
-            (covered_segment_mins / (min_seen + 1)) * 100 as coverage_percent,
-            total_kms - km_since_last_segment as km_travelled,
-            start_lat,
-            start_lon,
-            start_time,
-            end_lat,
-            end_lon,
-            end_time
-        from
-            twice_enriched
-        """
-    )
-    
-    sf_con.run(q)
-    
-    # Define column names
-    columns = [
-        'id',
-        'timestamp',
-        'latitude',
-        'longitude',
-        'supply_id',
-        'segment',
-        'locates',
-        'min_seen',
-        'coverage_percent',
-        'km_travelled',
-        'start_lat',
-        'start_lon',
-        'start_time',
-        'end_lat',
-        'end_lon',
-        'end_time'
-    ]
+    run = snowflake_runner()
 
     # Convert results to DataFrame
-    df = pd.DataFrame(q.results, columns=columns)
-
-    # Convert the time column to datetime
-    df['timestamp'] = pd.to_datetime(df['timestamp'])
-    
-    # Create 'fraud' column
-    df['fraud'] = None
-
-    # Use 742 as source of truth and automark
-    df['has_742'] = 0
-    df.loc[df['supply_id'] == '742', 'has_742'] = 1  
-    df.loc[df['has_742'] == 1, 'fraud'] = True  
+    df = locates_frame(run(locates_sql(device_id, minutes, truncation, km_threshold)))
 
     # Find max segment    
     max_segment = df['segment'].max()
     
     # Generate grouped dataframe
-    grouped_df = df.groupby(['segment']).agg({
-        'id': 'count',  # Count total rows
-        'timestamp': 'min',
-        'start_lat': 'max',
-        'start_lon': 'max',
-        'start_time': 'max',
-        'end_lat': 'max',
-        'end_lon': 'max',
-        'end_time': 'max',
-        'locates': 'max',
-        'min_seen': 'max',
-        'coverage_percent': 'max',
-        'km_travelled': 'max',
-        'fraud': 'max',
-        'supply_id': pd.Series.nunique,
-        'has_742': 'max'
-    }).reset_index()
+    grouped_df = group_segments(df)
 
     # Count total duplicate locates
     total_dupes_sum = grouped_df['locates'].sum() - len(grouped_df)
@@ -263,17 +114,34 @@ def query(device_id: str, minutes: int, truncation: int, km_threshold: int) -> b
         'locates': total_dupes_sum + len(df)
     }
 
-    st.session_state['stats'] = stats
-    st.session_state['df'] = df
-    st.session_state['segment_df'] = grouped_df
-    st.session_state['annotations'] = {}
-    st.session_state['start'] = time.time()
+    _load_device(df, grouped_df, stats)
     
     # Create an S3 filesystem object with your credentials
     outcome = write_df_async()
     print(f'csv saved? {outcome}')
     return True
 
+def query_summary(device_id: str, minutes: int, truncation: int, km_threshold: int) -> bool:
+
+    run = snowflake_runner()
+
+    # Only one row per segment comes back, the raw locates follow in the background
+    grouped_df = segments_frame(run(segments_sql(device_id, minutes, truncation, km_threshold)))
+
+    max_segment = grouped_df['segment'].max()
+    total_dupes_sum = grouped_df['locates'].sum() - len(grouped_df)
+
+    stats = {
+        'max_segment': max_segment,
+        'current_segment': 0,
+        'annotated': 0,
+        'duplicates': total_dupes_sum,
+        'locates': total_dupes_sum + grouped_df['id'].sum()
+    }
+
+    _load_device(None, grouped_df, stats, pending=fetch_locates_async(run, locates_sql(device_id, minutes, truncation, km_threshold)))
+    return True
+
 # Create color column based on segment values
 def get_map_color(segment):
     colors = {
@@ -299,41 +167,140 @@ def get_matrix_color(fraud):
 # Callbacks
 def previous_callback():
     st.session_state['stats']['current_segment'] = max(0, st.session_state['stats']['current_segment']-1)
+    st.session_state['selection_end'] = None
     st.session_state['rerun'] = True
 
 def next_callback():
     st.session_state['stats']['current_segment'] = min(st.session_state['stats']['max_segment'], st.session_state['stats']['current_segment']+1)
+    st.session_state['selection_end'] = None
     st.session_state['rerun'] = True
 
-def update_annotation(is_valid):
+def extend_selection_callback(step):
     current_segment = st.session_state['stats']['current_segment']
-    
-    # Create masks for the current segment
-    df_mask = st.session_state['df']['segment'] == current_segment
-    segment_df_mask = st.session_state['segment_df']['segment'] == current_segment
-    
-    # Update annotations and dataframes using masks
-    st.session_state['annotations'][current_segment] = is_valid
-    st.session_state['df'].loc[df_mask, 'fraud'] = is_valid
-    st.session_state['segment_df'].loc[segment_df_mask, 'fraud'] = is_valid
+    selection_end = st.session_state.get('selection_end') or current_segment
+    selection_end = min(max(selection_end + step, current_segment), st.session_state['stats']['max_segment'])
+
+    # A selection that collapses back onto the current segment is no selection
+    st.session_state['selection_end'] = selection_end if selection_end > current_segment else None
+    st.session_state['rerun'] = True
+
+def select_to_gap_callback():
+    current_segment = st.session_state['stats']['current_segment']
+    grouped_df = st.session_state['segment_df']
+
+    # Select up to the segment before the next jump larger than the gap threshold
+    gaps = geo.segment_gaps(grouped_df)
+    after = (grouped_df['segment'] > current_segment).to_numpy()
+    breaks = grouped_df['segment'].to_numpy()[after & (gaps > st.session_state['gap_km'])]
+    selection_end = int(breaks.min()) - 1 if len(breaks) else int(st.session_state['stats']['max_segment'])
+
+    st.session_state['selection_end'] = selection_end if selection_end > current_segment else None
+    st.session_state['rerun'] = True
+
+def label_segments(segments: dict, save: bool = False) -> bool:
+    # Without the raw locates nothing can be saved, so don't take labels that would be lost
+    if locates_failed():
+        st.toast("raw locates failed to load, retry them before labeling")
+        st.session_state['rerun'] = True
+        return False
+
+    # Marking a segment invalid (or undoing that) changes the speed score of the segments after it
+    segment_df = st.session_state['segment_df']
+    before = shared.label_values(segment_df[segment_df['segment'].isin(segments.keys())])
+    changes_validity = False in segments.values() or (before == False).any()
+
+    # Label in this session's overlay
+    st.session_state['annotations'].update(segments)
+    st.session_state['labels'].update(segments)
+    st.session_state['version'] = st.session_state.get('version', 0) + 1
+    if changes_validity:
+        priority.rescore(min(segments), max(segments))
+    overview.update(list(segments.keys()), list(segments.values()))
 
     # Update stats
-    st.session_state['stats']['annotated'] = st.session_state['stats']['max_segment'] - st.session_state['segment_df']['fraud'].isna().sum()
+    st.session_state['stats']['annotated'] = st.session_state['stats']['max_segment'] - shared.label_values(segment_df).isna().sum()
 
     # Check if all segments are annotated
     if st.session_state['stats']['annotated'] == st.session_state['stats']['max_segment']:
         st.balloons()
         st.session_state['rerun'] = True
-        add_meta()
+        # Only credit the device once its labels are written, sync_locates does it if they're still loading
+        if write_df_async():
+            st.session_state['annotations'] = {}
+            add_meta()
+        else:
+            st.session_state['meta_pending'] = True
         
 
-    # Write to dataframe if conditions are met
-    elif len(st.session_state['annotations']) > 10 or int(st.session_state['stats']['annotated']) == int(st.session_state['stats']['max_segment']):
+    # Write to dataframe if conditions are met, batches are always saved in one write
+    elif len(st.session_state['annotations']) > 10 or save or int(st.session_state['stats']['annotated']) == int(st.session_state['stats']['max_segment']):
         if write_df_async():
             st.session_state['annotations'] = {}
+    return True
+
+def update_annotation(is_valid):
+    current_segment = st.session_state['stats']['current_segment']
+    last_segment = st.session_state.get('selection_end') or current_segment
+    
+    # Label the current segment, or the whole selected range, and stay on it if that was refused
+    if not label_segments(dict.fromkeys(range(current_segment, last_segment + 1), is_valid), save=last_segment > current_segment):
+        return
+    st.session_state['selection_end'] = None
 
     # Move to next segment
-    st.session_state['stats']['current_segment'] = min(current_segment + 1, st.session_state['stats']['max_segment'])
+    st.session_state['stats']['current_segment'] = min(last_segment + 1, st.session_state['stats']['max_segment'])
+    st.session_state['rerun'] = True
+
+def priority_callback():
+    segment = priority.highest_risk_segment()
+    if segment is not None:
+        st.session_state['stats']['current_segment'] = segment
+    st.session_state['selection_end'] = None
+    st.session_state['rerun'] = True
+
+def accept_callback():
+    # Select the low risk run from the current segment for review, ↑ labels it like any selection
+    current_segment = st.session_state['stats']['current_segment']
+    selection_end = priority.low_risk_run(st.session_state['accept_confidence'], current_segment) or current_segment
+    st.session_state['selection_end'] = selection_end if selection_end > current_segment else None
+    st.session_state['rerun'] = True
+
+def overview_callback(kind):
+    points = st.session_state[f'overview_{kind}']['selection']['points']
+    if not points:
+        return
+    # Space bins are drawn only when occupied, map the point back to its bin
+    index = points[0]['point_index']
+    if kind == 'space':
+        index = st.session_state['overview_space_bins'][index]
+    segment = overview.bin_segment(kind, index)
+    if segment is not None:
+        st.session_state['stats']['current_segment'] = segment
+        st.session_state['selection_end'] = None
+    st.session_state['rerun'] = True
+
+def dedup_callback():
+    minutes = st.session_state['dedup_minutes']
+    truncation = st.session_state['dedup_truncation']
+
+    # Duplicates are recomputed locally from the raw locates, don't wait on them inside a callback
+    if not sync_locates():
+        applied = st.session_state.get('dedup') or {'minutes': st.session_state['minutes'], 'truncation': st.session_state['truncation']}
+        st.session_state['dedup_minutes'] = int(applied['minutes'])
+        st.session_state['dedup_truncation'] = int(applied['truncation'])
+        st.toast('duplicates can be recomputed once the raw locates have loaded')
+        return
+
+    # Display only. The saved file, its s3 path and the shared cache key stay on the parameters the
+    # device was loaded with, so only this session's segment frame gets the recomputed counts.
+    # Segments only depend on the km threshold and the loaded frames may be shared, so the
+    # counts go on shallow copies.
+    segment_df = st.session_state['segment_df'].copy(deep=False)
+    stats = apply_duplicates(st.session_state['df'].copy(deep=False), segment_df, minutes, truncation)
+    st.session_state['segment_df'] = segment_df
+    st.session_state['scores'] = None
+    st.session_state['stats'].update(stats)
+    st.session_state['dedup'] = {'minutes': minutes, 'truncation': truncation}
     st.session_state['rerun'] = True
 
 def refresh_callback():
@@ -351,6 +318,8 @@ def render_map():
             st.text('minutes: the minute interval used to determine duplication')
             st.text('km threshold: the km threshold used to create a new segment')
             st.text('segment: a group of locates that are grouped together by their geographical position')
+        import s3fs
+
         s3 = s3fs.S3FileSystem(
             key=st.secrets["aws"]["PUBLIC_KEY"],
             secret=st.secrets["aws"]["PRIVATE_KEY"]
@@ -381,10 +350,13 @@ def render_map():
             st.table(result.set_index('Rank'))
         return
     else:
+        import pydeck as pdk
 
-        grouped_df = st.session_state['segment_df']
+        grouped_df = shared.labeled(st.session_state['segment_df'])
+        # Extend the window to preview the whole selected range
+        selection_end = st.session_state.get('selection_end') or st.session_state['stats']['current_segment']
         filtered_df = grouped_df[
-            (grouped_df['segment'].isin([x for x in range(max(0, st.session_state['stats']['current_segment'] - 51), min(st.session_state['stats']['current_segment'] + 52, st.session_state['stats']['max_segment']+1))])) &
+            (grouped_df['segment'].isin([x for x in range(max(0, st.session_state['stats']['current_segment'] - 51), min(max(st.session_state['stats']['current_segment'] + 52, selection_end + 2), st.session_state['stats']['max_segment']+1))])) &
             ((grouped_df['segment'] >= st.session_state['stats']['current_segment']) | (grouped_df['fraud'] != False))
         ].copy()
         filtered_df = filtered_df.sort_values(by=['segment']).reset_index(drop=True)
@@ -393,66 +365,36 @@ def render_map():
         zoom_level = calculate_zoom_level(100)
         radius = calculate_radius(zoom_level)
 
-        points = []
-        lines = []
-
-        cp = []
-
-        for _, segment in filtered_df.iterrows():
-            segment_color = [37, 68, 65]  # Default color (current segment)
-            
-            if segment['segment'] < st.session_state['stats']['current_segment']:
-                segment_color = [255, 111, 89]  # Previous segments
-            elif segment['segment'] > st.session_state['stats']['current_segment']:
-                segment_color = [67, 170, 139]  # Next segments
-            
-            # Add start point
-            if segment_color == [37, 68, 65]:
-                cp.append({
-                    'latitude': segment['start_lat'],
-                    'longitude': segment['start_lon'],
-                    'color': segment_color
-                })
-                
-                # Add end point
-                cp.append({
-                    'latitude': segment['end_lat'],
-                    'longitude': segment['end_lon'],
-                    'color': segment_color
-                })
-            else:
-                points.append({
-                    'latitude': segment['start_lat'],
-                    'longitude': segment['start_lon'],
-                    'color': segment_color
-                })
-                
-                # Add end point
-                points.append({
-                    'latitude': segment['end_lat'],
-                    'longitude': segment['end_lon'],
-                    'color': segment_color
-                })
-            
-            # Add line for the segment
-            lines.append({
-                'source_lon': segment['start_lon'],
-                'source_lat': segment['start_lat'],
-                'target_lon': segment['end_lon'],
-                'target_lat': segment['end_lat'],
-                'color': segment_color
-            })
-            
-            # Add line connecting to the next segment if it exists
-            if _ < len(filtered_df) - 1:
-                next_segment = filtered_df.iloc[_ + 1]
-                lines.append({
-                    'source_lon': segment['end_lon'],
-                    'source_lat': segment['end_lat'],
-                    'target_lon': next_segment['start_lon'],
-                    'target_lat': next_segment['start_lat'],
-                    'color': segment_color
-                })
+        # Colour, points and lines for every segment in the window at once
+        segments = filtered_df['segment'].to_numpy()
+        palette = np.array([
+            [255, 111, 89],  # Previous segments
+            [37, 68, 65],    # Current segment (or selected range)
+            [67, 170, 139]   # Next segments
+        ])
+        kind = np.select([segments < st.session_state['stats']['current_segment'], segments > selection_end], [0, 2], 1)
+        colors = palette[np.repeat(kind, 2)].tolist()
+
+        # Start then end point of each segment, the current ones are drawn larger
+        ends = pd.DataFrame({
+            'latitude': np.column_stack([filtered_df['start_lat'], filtered_df['end_lat']]).ravel(),
+            'longitude': np.column_stack([filtered_df['start_lon'], filtered_df['end_lon']]).ravel(),
+            'color': colors
+        })
+        is_current = np.repeat(kind == 1, 2)
+        points = ends[~is_current].to_dict('records')
+        cp = ends[is_current].to_dict('records')
+
+        # Each segment's own line followed by the line connecting it to the next segment
+        next_lat = filtered_df['start_lat'].shift(-1)
+        next_lon = filtered_df['start_lon'].shift(-1)
+        lines = pd.DataFrame({
+            'source_lon': np.column_stack([filtered_df['start_lon'], filtered_df['end_lon']]).ravel(),
+            'source_lat': np.column_stack([filtered_df['start_lat'], filtered_df['end_lat']]).ravel(),
+            'target_lon': np.column_stack([filtered_df['end_lon'], next_lon]).ravel(),
+            'target_lat': np.column_stack([filtered_df['end_lat'], next_lat]).ravel(),
+            'color': colors
+        }).iloc[:-1].to_dict('records')
 
         point_layer = pdk.Layer(
             'ScatterplotLayer',
@@ -509,6 +451,7 @@ def render_sidebar():
             truncation = st.number_input("enter truncation:", value=4, min_value=3, max_value=6)
             minutes = st.number_input("enter minutes:", value=1, min_value=1, max_value=60)
             km_threshold = st.number_input("enter km threshold:", value=10, min_value=1, max_value=1000)
+            summary_first = st.checkbox('summary first', value=True, help='load segments first and fetch raw locates in the background')
             if st.button('search'):
                 try:
                     uuid.UUID(device_id)
@@ -524,13 +467,26 @@ def render_sidebar():
                     outcome = start()
                 if outcome:
                     st.session_state['rerun'] = True 
-                else:
+                elif outcome is False:
                     with st.spinner('querying data from snowflake...'):
-                        q_outcome = query(device_id, minutes, truncation, km_threshold)
+                        if summary_first:
+                            q_outcome = query_summary(device_id, minutes, truncation, km_threshold)
+                        else:
+                            q_outcome = query(device_id, minutes, truncation, km_threshold)
                     if q_outcome:
                         st.session_state['rerun'] = True 
         else:
+            # Plotting and shortcut components are only needed once a device is loaded
+            import plotly.graph_objects as go
+            from streamlit_extras.keyboard_text import key, load_key_css
+
             st.subheader(f"{st.session_state['device_id']}")
+            if not sync_locates() and st.session_state.get('pending_locates') is not None:
+                if locates_failed():
+                    st.error(f"raw locates failed to load, labels can't be saved until they do: {st.session_state['pending_locates']['error']}")
+                    st.button('retry loading locates', on_click=retry_locates)
+                else:
+                    st.caption('raw locates loading...')
             if 'stats' in st.session_state:
                 with st.container(border=True):
                     st.text(f"locates: {st.session_state['stats']['locates']:,.0f}")
@@ -540,7 +496,14 @@ def render_sidebar():
                     st.text(f"reviewed: {st.session_state['stats']['annotated']/st.session_state['stats']['max_segment']*100:,.1f}%")
                     st.progress(st.session_state['stats']['annotated']/st.session_state['stats']['max_segment']) 
                 with st.container(border=True):
-                    grouped_df = st.session_state['segment_df']
+                    st.text('duplication')
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        st.number_input("truncation:", min_value=3, max_value=6, key='dedup_truncation', on_change=dedup_callback)
+                    with col2:
+                        st.number_input("minutes:", min_value=1, max_value=60, key='dedup_minutes', on_change=dedup_callback)
+                with st.container(border=True):
+                    grouped_df = shared.labeled(st.session_state['segment_df'])
                     filtered_df = grouped_df[grouped_df['segment'].isin([x for x in range(max(0, st.session_state['stats']['current_segment'] - 51), min(st.session_state['stats']['current_segment'] + 51, st.session_state['stats']['max_segment']+1))])].copy()
                     filtered_df.loc[:, 'matrix_color'] = filtered_df['fraud'].apply(get_matrix_color)
                     filtered_df.loc[filtered_df['segment'] == st.session_state['stats']['current_segment'], 'matrix_color'] = 'rgba(255, 209, 102, 255)'
@@ -599,8 +562,8 @@ def render_sidebar():
                 load_key_css()
                 col1, col2 = st.columns([4, 1])
                 with col1:
-                    st.text('mark current locate good')
-                    st.text('mark current locate bad')
+                    st.text('mark current locate (or range) good')
+                    st.text('mark current locate (or range) bad')
                     st.text('go to next locate')
                     st.text('go to previous locate')
                 with col2: 
@@ -611,34 +574,123 @@ def render_sidebar():
                 st.divider()
                 col3, col4, col5, col6 = st.columns(4)
                 with col3:
-                    streamlit_shortcuts.button('↑', on_click=lambda: update_annotation(True), shortcut="ArrowUp")
+                    st.button('↑', on_click=lambda: update_annotation(True))
                 with col4:
-                    streamlit_shortcuts.button('↓', on_click=lambda: update_annotation(False), shortcut="ArrowDown")   
+                    st.button('↓', on_click=lambda: update_annotation(False))   
                 with col5:
-                    streamlit_shortcuts.button("→", on_click=next_callback, shortcut="ArrowRight")
+                    st.button("→", on_click=next_callback)
                 with col6:
-                    streamlit_shortcuts.button("←", on_click=previous_callback, shortcut="ArrowLeft")  
+                    st.button("←", on_click=previous_callback)  
+
+            # Range selection
+            with st.container(border=True):
+                st.text('range')
+                col1, col2 = st.columns([4, 1])
+                with col1:
+                    st.text('extend selection')
+                    st.text('shrink selection')
+                with col2:
+                    key("⇧→")
+                    key("⇧←")
+                col3, col4 = st.columns(2)
+                with col3:
+                    st.button("⇧→", on_click=lambda: extend_selection_callback(1))
+                with col4:
+                    st.button("⇧←", on_click=lambda: extend_selection_callback(-1))
+                # Registered together so plain and shifted arrows never trigger each other
+                keyboard_shortcuts({
+                    'ArrowUp': '↑',
+                    'ArrowDown': '↓',
+                    'ArrowRight': '→',
+                    'ArrowLeft': '←',
+                    'Shift+ArrowRight': '⇧→',
+                    'Shift+ArrowLeft': '⇧←'
+                })
+                st.number_input("gap km:", value=10, min_value=1, max_value=10000, key='gap_km')
+                st.button('select until next gap', on_click=select_to_gap_callback)
+                if st.session_state.get('selection_end') is not None:
+                    first, last = st.session_state['stats']['current_segment'], st.session_state['selection_end']
+                    st.text(f"selected: {first:,.0f}-{last:,.0f} ({last - first + 1:,.0f} segments)")
+
+            # Review queue
+            with st.container(border=True):
+                st.text('review queue')
+                scores = priority.ensure_scores()
+                position = st.session_state['segment_df']['segment'].searchsorted(st.session_state['stats']['current_segment'])
+                st.text(f"current risk: {scores[position]:,.2f}")
+                st.button('jump to highest risk', on_click=priority_callback)
+                confidence = st.number_input("low risk confidence:", value=0.95, min_value=0.5, max_value=1.0, step=0.01, key='accept_confidence')
+                run_end = priority.low_risk_run(confidence, st.session_state['stats']['current_segment'])
+                run = 0 if run_end is None else run_end - st.session_state['stats']['current_segment'] + 1
+                st.button(f"select {run:,.0f} low risk", on_click=accept_callback, disabled=run == 0)
+
+def render_overview():
+    import plotly.graph_objects as go
+
+    bins = overview.ensure()
+    colors = {'unlabeled': 'rgba(163, 186, 195, .75)', 'good': 'rgba(67, 170, 139, .75)', 'bad': 'rgba(255, 111, 89, .75)'}
+    col1, col2 = st.columns([2, 1])
+    with col1:
+        # Timeline, one stacked bar per time bin
+        starts = pd.to_datetime(bins['time_edges'][:-1].astype('int64'), utc=True).floor('s')
+        current_bin = bins['time_bin'][st.session_state['segment_df']['segment'].searchsorted(st.session_state['stats']['current_segment'])]
+        fig = go.Figure(data=[
+            go.Bar(x=starts, y=bins['time_counts'][:, i], name=status, marker_color=colors[status])
+            for i, status in enumerate(overview.STATUS)
+        ])
+        fig.add_vline(x=starts[current_bin], line_color='rgba(255, 209, 102, 255)', line_width=2)
+        fig.update_layout(barmode='stack', showlegend=False, height=300, margin=dict(l=0, r=0, t=0, b=0), bargap=0)
+        st.text('timeline')
+        st.plotly_chart(fig, on_select=lambda: overview_callback('time'), selection_mode='points', key='overview_time')
+    with col2:
+        # Spatial grid, occupied bins only, colored by share labeled bad
+        counts = bins['space_counts']
+        occupied = np.flatnonzero(counts.sum(axis=1))
+        st.session_state['overview_space_bins'] = occupied
+        lat_centers = (bins['lat_edges'][:-1] + bins['lat_edges'][1:]) / 2
+        lon_centers = (bins['lon_edges'][:-1] + bins['lon_edges'][1:]) / 2
+        totals = counts[occupied].sum(axis=1)
+        fig = go.Figure(data=[go.Scatter(
+            x=lon_centers[occupied % overview.SPACE_BINS],
+            y=lat_centers[occupied // overview.SPACE_BINS],
+            mode='markers',
+            marker=dict(
+                symbol='square',
+                size=np.clip(np.sqrt(totals) * 2, 6, 24),
+                color=counts[occupied, 2] / totals,
+                colorscale=[[0, colors['good']], [1, colors['bad']]],
+                cmin=0,
+                cmax=1
+            ),
+            text=[f"{t:,.0f} segments, {u:,.0f} unlabeled" for t, u in zip(totals, counts[occupied, 0])],
+            hoverinfo='text'
+        )])
+        fig.update_layout(showlegend=False, height=300, margin=dict(l=0, r=0, t=0, b=0), xaxis_title='lon', yaxis_title='lat')
+        st.text('space')
+        st.plotly_chart(fig, on_select=lambda: overview_callback('space'), selection_mode='points', key='overview_space')
 
 def render_stats():
-    grouped_df = st.session_state['segment_df']
+    grouped_df = shared.labeled(st.session_state['segment_df'])
+
+    # Row positions of the previous valid, current and next segment, and the distance, time and
+    # speed from the last valid segment before each of them, all in one pass
+    previous = priority.last_valid(grouped_df['fraud'])
+    current = int(grouped_df['segment'].searchsorted(st.session_state['stats']['current_segment']))
+    panels = np.array([previous[current], current, current + 1 if current + 1 < len(grouped_df) else -1])
+    lags = np.where(panels >= 0, previous[panels], -1)
+    hop = geo.hops(grouped_df, lags, np.maximum(panels, 0))
+    mph = hop['kmh'] * geo.KM_TO_MILES
+    time_fmt, time_unit = zip(*[alt_format_minutes(m) for m in np.trunc(hop['minutes'])])
+
     col1, col2, col3 = st.columns(3)  
     with col1:
         with st.container(height=325):
-            prev_filtered_df = grouped_df[(grouped_df['fraud'] != False) & (grouped_df['segment'] < st.session_state['stats']['current_segment'])]
-            if prev_filtered_df.empty:
+            if panels[0] < 0:
                 pass 
             else:
-                closest_segment = int(prev_filtered_df['segment'].max())
-                target_segment = prev_filtered_df.loc[prev_filtered_df['segment'] == closest_segment]
+                target_segment = grouped_df.iloc[[panels[0]]]
                 fraud_val = target_segment['fraud'].values[0]
 
-                two_lag_df = prev_filtered_df[prev_filtered_df['segment'] < closest_segment]
-                if two_lag_df.empty:
-                    tl_segment = pd.DataFrame({})
-                else:
-                    tln_segment = int(two_lag_df['segment'].max())
-                    tl_segment = two_lag_df.loc[two_lag_df['segment'] == tln_segment]
-
                 if fraud_val == True:
                     st.subheader('previous ✅')
                 elif fraud_val == False:
@@ -649,43 +701,24 @@ def render_stats():
                 with scol1:
                     st.metric('locates', f"{human_format(target_segment['id'].values[0])}")
                     st.metric('time seen', f"{format_minutes(target_segment['min_seen'].values[0])}")
-                    if not tl_segment.empty:
-                        distance = calculate_distance(
-                            tl_segment['end_lat'].values[0],
-                            tl_segment['end_lon'].values[0],
-                            target_segment['start_lat'].values[0],
-                            target_segment['start_lon'].values[0]
-                        )
-                        st.metric('km sll', f"{human_format(distance)}")
+                    if lags[0] >= 0:
+                        st.metric('km sll', f"{human_format(hop['km'][0])}")
                 with scol2:
                     st.metric('duplicates', f"{human_format(target_segment['locates'].values[0])}")
                     st.metric('coverage %', f"{target_segment['coverage_percent'].values[0]:,.0f}%")
-                    if not tl_segment.empty:
-                        time_diff = (target_segment['start_time'].values[0] - tl_segment['end_time'].values[0])
-                        time_diff_minutes = time_diff.astype('timedelta64[m]').astype(int)
-                        time_fmt, time_unit = alt_format_minutes(time_diff_minutes)
-                    
-                        st.metric(f'{time_unit} sll', f"{time_fmt}")
+                    if lags[0] >= 0:
+                        st.metric(f'{time_unit[0]} sll', f"{time_fmt[0]}")
                 with scol3:
                     st.metric('apps', f"{target_segment['supply_id'].values[0]}")
                     st.metric('km travelled', f"{human_format(target_segment['km_travelled'].values[0])}")
-                    if not tl_segment.empty:
-                        mph = (distance / time_diff_minutes) * 60 * 0.621371
-                        st.metric('mph sll', f"{mph:,.0f}")
+                    if lags[0] >= 0:
+                        st.metric('mph sll', f"{mph[0]:,.0f}")
                                                     
     with col2:
         with st.container(height=325):
-            target_segment = grouped_df.loc[grouped_df['segment'] == st.session_state['stats']['current_segment']]
+            target_segment = grouped_df.iloc[[panels[1]]]
             fraud_val = target_segment['fraud'].values[0]
 
-            two_lag_df = prev_filtered_df[prev_filtered_df['segment'] < st.session_state['stats']['current_segment']]
-            if two_lag_df.empty:
-                tl_segment = pd.DataFrame({})
-                    
-            else:
-                tln_segment = int(two_lag_df['segment'].max())
-                tl_segment = two_lag_df.loc[two_lag_df['segment'] == tln_segment]
-
             if fraud_val == True:
                 st.subheader('current ✅')
             elif fraud_val == False:
@@ -696,45 +729,24 @@ def render_stats():
             with scol1:
                 st.metric('locates', f"{human_format(target_segment['id'].values[0])}")
                 st.metric('time seen', f"{format_minutes(target_segment['min_seen'].values[0])}")
-                if not tl_segment.empty:
-                    distance = calculate_distance(
-                        tl_segment['end_lat'].values[0],
-                        tl_segment['end_lon'].values[0],
-                        target_segment['start_lat'].values[0],
-                        target_segment['start_lon'].values[0]
-                    )
-                    st.metric('km sll', f"{human_format(distance)}")
+                if lags[1] >= 0:
+                    st.metric('km sll', f"{human_format(hop['km'][1])}")
             with scol2:
                 st.metric('duplicates', f"{human_format(target_segment['locates'].values[0])}")
                 st.metric('coverage %', f"{target_segment['coverage_percent'].values[0]:,.0f}%")
-                if not tl_segment.empty:
-                    time_diff = (target_segment['start_time'].values[0] - tl_segment['end_time'].values[0])
-                    time_diff_minutes = time_diff.astype('timedelta64[m]').astype(int)
-                    time_fmt, time_unit = alt_format_minutes(time_diff_minutes)
-                    
-                    st.metric(f'{time_unit} sll', f"{time_fmt}")
+                if lags[1] >= 0:
+                    st.metric(f'{time_unit[1]} sll', f"{time_fmt[1]}")
             with scol3:
                 st.metric('apps', f"{target_segment['supply_id'].values[0]}")
                 st.metric('km travelled', f"{human_format(target_segment['km_travelled'].values[0])}")
-                if not tl_segment.empty:
-                    if time_diff_minutes > 0:
-                        mph = (distance / time_diff_minutes) * 60 * 0.621371
-                    else:
-                        mph = distance * 60 * 0.621371
-                    st.metric('mph sll', f"{mph:,.0f}")
+                if lags[1] >= 0:
+                    st.metric('mph sll', f"{mph[1]:,.0f}")
     with col3:
         with st.container(height=325):
-            if st.session_state['stats']['current_segment'] + 1 <= st.session_state['stats']['max_segment']:
-                target_segment = grouped_df.loc[grouped_df['segment'] == st.session_state['stats']['current_segment'] + 1]
+            if panels[2] >= 0:
+                target_segment = grouped_df.iloc[[panels[2]]]
                 fraud_val = target_segment['fraud'].values[0]
                 
-                two_lag_df = prev_filtered_df[prev_filtered_df['segment'] < st.session_state['stats']['current_segment'] + 1]
-                if two_lag_df.empty:
-                    tl_segment = pd.DataFrame({})
-                else:
-                    tln_segment = int(two_lag_df['segment'].max())
-                    tl_segment = two_lag_df.loc[two_lag_df['segment'] == tln_segment]
-                
                 if fraud_val == True:
                     st.subheader('next ✅')
                 elif fraud_val == False:
@@ -745,29 +757,18 @@ def render_stats():
                 with scol1:
                     st.metric('locates', f"{human_format(target_segment['id'].values[0])}")
                     st.metric('time seen', f"{format_minutes(target_segment['min_seen'].values[0])}")
-                    if not tl_segment.empty:
-                        distance = calculate_distance(
-                            tl_segment['end_lat'].values[0],
-                            tl_segment['end_lon'].values[0],
-                            target_segment['start_lat'].values[0],
-                            target_segment['start_lon'].values[0]
-                        )
-                        st.metric('km sls', f"{human_format(distance)}")
+                    if lags[2] >= 0:
+                        st.metric('km sls', f"{human_format(hop['km'][2])}")
                 with scol2:
                     st.metric('duplicates', f"{human_format(target_segment['locates'].values[0])}")
                     st.metric('time coverage', f"{target_segment['coverage_percent'].values[0]:,.0f}%")
-                    if not tl_segment.empty:
-                        time_diff = (target_segment['start_time'].values[0] - tl_segment['end_time'].values[0])
-                        time_diff_minutes = time_diff.astype('timedelta64[m]').astype(int)
-                        time_fmt, time_unit = alt_format_minutes(time_diff_minutes)
-                    
-                        st.metric(f'{time_unit} sll', f"{time_fmt}")
+                    if lags[2] >= 0:
+                        st.metric(f'{time_unit[2]} sll', f"{time_fmt[2]}")
                 with scol3:
                     st.metric('apps', f"{target_segment['supply_id'].values[0]}")
                     st.metric('km travelled', f"{human_format(target_segment['km_travelled'].values[0])}")
-                    if not tl_segment.empty:
-                        mph = (distance / time_diff_minutes) * 60 * 0.621371
-                        st.metric('mph sll', f"{mph:,.0f}")
+                    if lags[2] >= 0:
+                        st.metric('mph sll', f"{mph[2]:,.0f}")
 
 # Streamlit app
 def main():
@@ -778,21 +779,42 @@ def main():
         with st.expander('map', expanded=True):
             render_map()
             render_stats()
+        # Binned whole device view, only built once it is switched on
+        if st.toggle('device overview', key='show_overview'):
+            with st.expander('overview', expanded=True):
+                render_overview()
     
     with st.expander('Results', expanded=False):
         if 'df' in st.session_state:
             st.write("Download the annotated dataframe:")
-            
-            # Convert dataframe to CSV
-            csv = st.session_state['df'].to_csv(index=False)
-            
-            # Create a download button
-            st.download_button(
-                label="Download CSV",
-                data=csv,
-                file_name="annotated_dataframe.csv",
-                mime="text/csv",
-            )
+
+            col1, col2 = st.columns(2)
+            with col1:
+                fmt = st.selectbox('format', list(EXPORT_FORMATS), format_func=lambda x: EXPORT_FORMATS[x]['label'])
+            with col2:
+                labels_only = st.checkbox('labels only', value=False)
+
+            # Only serialize on request, and reuse the file until the labels change. The download
+            # button reads the whole file every time it renders, so it is only shown on the rerun
+            # right after 'prepare download' instead of on every keypress.
+            ready = st.session_state.pop('export_ready', None)
+            cached = st.session_state.get('exports', {}).get((fmt, labels_only))
+            if not labels_only and st.session_state['df'] is None:
+                st.write("Raw locates are still loading, only labels can be downloaded.")
+            elif ready != (fmt, labels_only) or cached is None or cached['version'] != st.session_state.get('version', 0):
+                if st.button('prepare download'):
+                    with st.spinner('building export...'):
+                        build_export(fmt, labels_only)
+                    st.session_state['export_ready'] = (fmt, labels_only)
+                    st.session_state['rerun'] = True
+            else:
+                with open(cached['path'], 'rb') as f:
+                    st.download_button(
+                        label=f"Download {EXPORT_FORMATS[fmt]['label']}",
+                        data=f,
+                        file_name=export_file_name(fmt, labels_only),
+                        mime=EXPORT_FORMATS[fmt]['mime'],
+                    )
         else:
             st.write("No data available for download.")
 
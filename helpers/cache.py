@@ -0,0 +1,158 @@
+import os
+import glob
+import hashlib
+import tempfile
+
+
+# Local disk cache of device files shared by every streamlit worker on the box. Each version of a
+# file is stored under its own name ({s3 path hash}.{etag hash}.data), so what a file holds and
+# which version it is are always replaced together by one atomic rename.
+CACHE_DIR = os.environ.get('ANNOTATOR_CACHE_DIR', os.path.expanduser('~/.cache/geotime-annotator'))
+CACHE_MAX_BYTES = int(os.environ.get('ANNOTATOR_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+
+
+def _name(s3_path: str) -> str:
+    return hashlib.sha1(s3_path.encode()).hexdigest()
+
+
+def _data_path(s3_path: str, etag: str) -> str:
+    version = hashlib.sha1(str(etag).encode()).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, f'{_name(s3_path)}.{version}.data')
+
+
+def _remote_etag(s3, s3_path: str) -> str:
+    # HEAD the object, skipping s3fs's own listing cache so changes from other hosts are seen
+    s3.invalidate_cache(s3_path)
+    return s3.info(s3_path).get('ETag')
+
+
+def _upload(s3, local_path: str, s3_path: str) -> str:
+    # PUT the file and return the etag S3 gave this upload, a HEAD afterwards could already
+    # see another host's write
+    bucket, key = s3_path.replace('s3://', '', 1).split('/', 1)
+    with open(local_path, 'rb') as f:
+        response = s3.call_s3('put_object', Bucket=bucket, Key=key, Body=f)
+    s3.invalidate_cache(s3_path)
+    return response['ETag']
+
+
+def _write_tmp(write_fn) -> str:
+    # write next to the target so the final rename is atomic for other workers
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write_fn(f)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path
+
+
+def _discard(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _commit(s3_path: str, etag: str, tmp_path: str) -> str:
+    data_path = _data_path(s3_path, etag)
+    # two workers committing the same version write the same bytes, so either rename can win
+    os.replace(tmp_path, data_path)
+    # other versions of the file are never read again, open handles to them stay valid
+    for path in glob.glob(os.path.join(CACHE_DIR, f'{_name(s3_path)}.*.data')):
+        if path != data_path:
+            _discard(path)
+    # never evict what was just stored, even when it alone is over the limit
+    evict(keep=[data_path])
+    return data_path
+
+
+def fetch(s3, s3_path: str):
+    # Open s3_path for reading, downloading only when the remote etag has changed. Returns the
+    # open file and its etag. The file is opened before it can be evicted and an open file
+    # survives removal, so eviction by this or another worker never breaks a read. Any local
+    # disk error falls back to reading S3 directly, errors from S3 itself are raised.
+    etag = _remote_etag(s3, s3_path)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        data_path = _data_path(s3_path, etag)
+        try:
+            f = open(data_path, 'rb')
+            # bump mtime, eviction is least recently used first
+            os.utime(data_path)
+            print(f"cache hit: {s3_path}")
+            return f, etag
+        except FileNotFoundError:
+            # not cached yet, or evicted by another worker in the meantime
+            pass
+
+        def _download(f):
+            with s3.open(s3_path, 'rb') as remote:
+                while True:
+                    chunk = remote.read(8 * 1024 * 1024)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+
+        print(f"cache miss: {s3_path}")
+        tmp_path = _write_tmp(_download)
+        f = open(tmp_path, 'rb')
+    except OSError as e:
+        print(f"cache unavailable, reading s3 directly: {e}")
+        return s3.open(s3_path, 'rb'), etag
+
+    try:
+        _commit(s3_path, etag, tmp_path)
+    except OSError as e:
+        # the open file is still complete, only storing it for next time failed
+        print(f"error caching {s3_path}: {e}")
+        _discard(tmp_path)
+    return f, etag
+
+
+def put(s3, s3_path: str, write_fn):
+    # Write a new version locally, upload it, then store it under the etag the upload got. If the
+    # local copy can't be written the file goes straight to S3 instead.
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = _write_tmp(write_fn)
+    except OSError as e:
+        print(f"cache unavailable, writing s3 directly: {e}")
+        with s3.open(s3_path, 'wb') as f:
+            write_fn(f)
+        return
+
+    try:
+        etag = _upload(s3, tmp_path, s3_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    try:
+        _commit(s3_path, etag, tmp_path)
+    except OSError as e:
+        print(f"error caching {s3_path}: {e}")
+        _discard(tmp_path)
+
+
+def evict(max_bytes: int = None, keep=()):
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    entries = []
+    total = 0
+    for name in os.listdir(CACHE_DIR):
+        if not name.endswith('.data'):
+            continue
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        total += stat.st_size
+        if path not in keep:
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        _discard(path)
+        total -= size
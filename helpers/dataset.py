@@ -0,0 +1,162 @@
+import os
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import fsspec
+import pandas as pd
+
+
+# Builds a consolidated training set from the per-device annotation files under
+#   {source}/raw_input/{truncation}/{minutes}/{km_threshold}/{device_id}.csv
+# into a parquet dataset partitioned by the same parameters. Only devices whose
+# file changed since the last run are re-read.
+#
+#   python -m helpers.dataset s3://a6dev-mltraining ./training
+
+MANIFEST = '_manifest.json'
+
+DTYPES = {
+    'id': 'string',
+    'latitude': 'float64',
+    'longitude': 'float64',
+    'supply_id': 'string',
+    'source': 'string',
+    'segment': 'int64',
+    'locates': 'int64',
+    'min_seen': 'float64',
+    'coverage_percent': 'float64',
+    'km_travelled': 'float64',
+    'start_lat': 'float64',
+    'start_lon': 'float64',
+    'end_lat': 'float64',
+    'end_lon': 'float64',
+    'has_742': 'int8',
+}
+TIME_COLUMNS = ['timestamp', 'start_time', 'end_time']
+
+
+def _version(info: dict) -> str:
+    # s3 gives an etag, local stand-ins only have an mtime
+    tag = info.get('ETag') or info.get('LastModified') or info.get('mtime') or info.get('created')
+    return f"{tag}:{info.get('size')}"
+
+
+def list_files(fs, root: str) -> dict:
+    files = {}
+    for path, info in fs.find(f"{root.rstrip('/')}/raw_input", detail=True).items():
+        parts = path.rstrip('/').split('/')
+        if not path.endswith('.csv') or len(parts) < 5:
+            continue
+        truncation, minutes, km_threshold, name = parts[-4:]
+        files[path] = {
+            'truncation': int(truncation),
+            'minutes': int(minutes),
+            'km_threshold': int(km_threshold),
+            'device_id': name[:-len('.csv')],
+            'version': _version(info)
+        }
+    return files
+
+
+def normalize(df: pd.DataFrame, meta: dict) -> pd.DataFrame:
+    # Keep labeled segments only
+    df = df[df['fraud'].notna()].copy()
+    df['fraud'] = df['fraud'].astype(str).str.lower().map({'true': True, 'false': False, '1.0': True, '0.0': False, '1': True, '0': False}).astype('boolean')
+    df = df[df['fraud'].notna()]
+
+    if 'source' not in df.columns:
+        df['source'] = None
+    for column, dtype in DTYPES.items():
+        df[column] = df[column].astype(dtype)
+    for column in TIME_COLUMNS:
+        df[column] = pd.to_datetime(df[column], utc=True, format='mixed')
+
+    df['device_id'] = meta['device_id']
+    return df[['device_id'] + list(DTYPES) + TIME_COLUMNS + ['fraud']]
+
+
+def partition_path(out: str, meta: dict) -> str:
+    return f"{out.rstrip('/')}/truncation={meta['truncation']}/minutes={meta['minutes']}/km_threshold={meta['km_threshold']}/{meta['device_id']}.parquet"
+
+
+def _process(fs, out_fs, out: str, path: str, meta: dict) -> int:
+    with fs.open(path, 'rb') as f:
+        df = normalize(pd.read_csv(f, dtype={'supply_id': str, 'id': str}), meta)
+
+    target = partition_path(out, meta)
+    if df.empty:
+        # nothing labeled yet, drop any stale partition file
+        if out_fs.exists(target):
+            out_fs.rm(target)
+        return 0
+
+    out_fs.makedirs(os.path.dirname(target), exist_ok=True)
+    with out_fs.open(target, 'wb') as f:
+        df.to_parquet(f, index=False)
+    return len(df)
+
+
+def _read_manifest(out_fs, out: str) -> dict:
+    path = f"{out.rstrip('/')}/{MANIFEST}"
+    if not out_fs.exists(path):
+        return {}
+    with out_fs.open(path, 'r') as f:
+        return json.load(f)
+
+
+def _write_manifest(out_fs, out: str, manifest: dict):
+    path = f"{out.rstrip('/')}/{MANIFEST}"
+    with out_fs.open(path, 'w') as f:
+        json.dump(manifest, f)
+
+
+def build(source: str, out: str, workers: int = 16, storage_options: dict = None) -> dict:
+    fs, root = fsspec.core.url_to_fs(source, **(storage_options or {}))
+    out_fs, _ = fsspec.core.url_to_fs(out)
+    out_fs.makedirs(out, exist_ok=True)
+
+    files = list_files(fs, root)
+    manifest = _read_manifest(out_fs, out)
+    changed = {path: meta for path, meta in files.items() if manifest.get(path, {}).get('version') != meta['version']}
+    removed = [path for path in manifest if path not in files]
+
+    for path in removed:
+        target = partition_path(out, manifest.pop(path))
+        if out_fs.exists(target):
+            out_fs.rm(target)
+
+    rows = 0
+    errors = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_process, fs, out_fs, out, path, meta): path for path, meta in changed.items()}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                rows += future.result()
+                manifest[path] = files[path]
+            except Exception as e:
+                # left out of the manifest so the next run retries it
+                errors += 1
+                print(f'error processing {path}: {e}')
+
+    _write_manifest(out_fs, out, manifest)
+
+    summary = {
+        'files': len(files),
+        'processed': len(changed) - errors,
+        'skipped': len(files) - len(changed),
+        'removed': len(removed),
+        'errors': errors,
+        'rows': rows
+    }
+    print(summary)
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='build a partitioned training dataset from raw_input annotations')
+    parser.add_argument('source', help='bucket or directory containing raw_input/, e.g. s3://a6dev-mltraining')
+    parser.add_argument('out', help='output directory for the parquet dataset')
+    parser.add_argument('--workers', type=int, default=16, help='concurrent downloads')
+    args = parser.parse_args()
+    build(args.source, args.out, workers=args.workers)
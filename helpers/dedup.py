@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+
+
+# Mirrors the SQL in query():
+#   rh = md5_hex(concat(time_slice(timestamp, minutes, 'minute'), trunc(latitude, truncation), trunc(longitude, truncation)))
+#   duplicates = count(1) over (partition by rh) - 1
+#   locates = sum(duplicates) over (partition by segment)
+# but with integer keys so a new truncation/minutes value never needs a warehouse query.
+
+
+def time_buckets(timestamps: pd.Series, minutes: int) -> np.ndarray:
+    # time_slice buckets are aligned to the unix epoch
+    ts = pd.to_datetime(timestamps, utc=True)
+    seconds = ts.astype('int64').to_numpy() // 1_000_000_000
+    return seconds // (int(minutes) * 60)
+
+
+def truncate_coords(values: pd.Series, truncation: int) -> np.ndarray:
+    scaled = values.to_numpy(dtype='float64') * (10 ** int(truncation))
+    # round away float noise first so 40.1234 doesn't truncate to 40.1233
+    return np.trunc(np.round(scaled, 6)).astype('int64')
+
+
+def _combine(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # Pack two integer columns into one dense code, both sides are re-factorized
+    # first so the product of their cardinalities always fits in an int64
+    a_codes, _ = pd.factorize(a, sort=True)
+    b_codes, b_uniques = pd.factorize(b, sort=True)
+    return a_codes.astype('int64') * len(b_uniques) + b_codes
+
+
+def row_keys(df: pd.DataFrame, minutes: int, truncation: int) -> np.ndarray:
+    keys = _combine(time_buckets(df['timestamp'], minutes), truncate_coords(df['latitude'], truncation))
+    keys = _combine(keys, truncate_coords(df['longitude'], truncation))
+    # the warehouse counts each source table separately (count over rh inside each union branch)
+    if 'source' in df.columns:
+        keys = _combine(pd.factorize(df['source'])[0], keys)
+    return keys
+
+
+def duplicate_counts(df: pd.DataFrame, minutes: int, truncation: int) -> np.ndarray:
+    keys = row_keys(df, minutes, truncation)
+    _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    return counts[inverse] - 1
+
+
+def segment_locates(df: pd.DataFrame, duplicates: np.ndarray) -> pd.Series:
+    segments = df['segment'].to_numpy(dtype='int64')
+    totals = np.bincount(segments, weights=duplicates, minlength=segments.max() + 1 if len(segments) else 0)
+    present = np.unique(segments)
+    return pd.Series(totals[present].astype('int64'), index=present, name='locates')
+
+
+def apply_duplicates(df: pd.DataFrame, segment_df: pd.DataFrame, minutes: int, truncation: int) -> dict:
+    # Recompute locates in place on both frames and return the matching stats
+    duplicates = duplicate_counts(df, minutes, truncation)
+    locates = segment_locates(df, duplicates)
+
+    df['locates'] = df['segment'].map(locates).to_numpy()
+    segment_df['locates'] = segment_df['segment'].map(locates).fillna(0).astype('int64').to_numpy()
+
+    total_dupes_sum = segment_df['locates'].sum() - len(segment_df)
+    return {
+        'duplicates': total_dupes_sum,
+        'locates': total_dupes_sum + len(df)
+    }
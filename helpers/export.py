@@ -0,0 +1,97 @@
+import os
+import weakref
+import tempfile
+import streamlit as st
+import pandas as pd
+from helpers import shared
+
+
+EXPORT_FORMATS = {
+    'csv': {'label': 'CSV', 'ext': 'csv', 'mime': 'text/csv'},
+    'csv.gz': {'label': 'CSV (gzip)', 'ext': 'csv.gz', 'mime': 'application/gzip'},
+    'parquet': {'label': 'Parquet', 'ext': 'parquet', 'mime': 'application/octet-stream'},
+}
+
+# rows written per chunk so large devices never become one in-memory string
+CHUNK_ROWS = 100_000
+
+
+class _Exports(dict):
+    # The session's prepared files by (fmt, labels_only). Streamlit drops a session's state once it
+    # ends, the finalizer then removes whatever files are left.
+
+    def __init__(self):
+        super().__init__()
+        self.paths = set()
+        weakref.finalize(self, _remove, self.paths)
+
+
+def _remove(paths: set):
+    for path in list(paths):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        paths.discard(path)
+
+
+def _exports() -> _Exports:
+    if not isinstance(st.session_state.get('exports'), _Exports):
+        st.session_state['exports'] = _Exports()
+    return st.session_state['exports']
+
+
+def labels_frame() -> pd.DataFrame:
+    return shared.labeled(st.session_state['segment_df'])[['segment', 'start_time', 'end_time', 'fraud']]
+
+
+def _write_parquet(df: pd.DataFrame, path: str):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # object columns mix None/bool/str so let arrow infer from the whole frame once
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    with pq.ParquetWriter(path, schema) as writer:
+        for start in range(0, max(len(df), 1), CHUNK_ROWS):
+            chunk = df.iloc[start:start + CHUNK_ROWS]
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+
+def build_export(fmt: str, labels_only: bool = False) -> str:
+    # Exports are keyed to the annotation version so they are only rebuilt once labels change
+    exports = _exports()
+    version = st.session_state.get('version', 0)
+    cache_key = (fmt, labels_only)
+
+    cached = exports.get(cache_key)
+    if cached is not None and cached['version'] == version and os.path.exists(cached['path']):
+        return cached['path']
+
+    df = labels_frame() if labels_only else shared.labeled(st.session_state['df'])
+    fd, path = tempfile.mkstemp(suffix=f".{EXPORT_FORMATS[fmt]['ext']}")
+    os.close(fd)
+
+    if fmt == 'parquet':
+        _write_parquet(df, path)
+    else:
+        # to_csv streams chunksize rows at a time straight to the file
+        compression = 'gzip' if fmt == 'csv.gz' else None
+        df.to_csv(path, index=False, compression=compression, chunksize=CHUNK_ROWS)
+
+    if cached is not None:
+        _remove({cached['path']})
+        exports.paths.discard(cached['path'])
+    exports[cache_key] = {'version': version, 'path': path}
+    exports.paths.add(path)
+    return path
+
+
+def export_file_name(fmt: str, labels_only: bool = False) -> str:
+    device_id = st.session_state['device_id'].lower()
+    kind = 'labels' if labels_only else 'annotated'
+    return f"{device_id}_{kind}.{EXPORT_FORMATS[fmt]['ext']}"
+
+
+def clear_exports():
+    _remove(_exports().paths)
+    st.session_state['exports'] = _Exports()
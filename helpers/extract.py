@@ -0,0 +1,321 @@
+import threading
+import streamlit as st
+import pandas as pd
+from helpers.misc import write_df_async, add_meta
+
+
+LOCATE_ATTEMPTS = 3
+
+LOCATE_COLUMNS = [
+    'id',
+    'timestamp',
+    'latitude',
+    'longitude',
+    'supply_id',
+    'source',
+    'segment',
+    'locates',
+    'min_seen',
+    'coverage_percent',
+    'km_travelled',
+    'start_lat',
+    'start_lon',
+    'start_time',
+    'end_lat',
+    'end_lon',
+    'end_time'
+]
+
+SEGMENT_COLUMNS = [
+    'segment',
+    'id',
+    'timestamp',
+    'start_lat',
+    'start_lon',
+    'start_time',
+    'end_lat',
+    'end_lon',
+    'end_time',
+    'locates',
+    'min_seen',
+    'coverage_percent',
+    'km_travelled',
+    'supply_id',
+    'has_742'
+]
+
+
+def _segments_cte(device_id: str, minutes: int, truncation: int, km_threshold: int) -> str:
+    return f"""
+        with all_data as (
+            select 
+                lower(idfa) as id, 
+                timestamp,
+                latitude,
+                longitude,
+                supply_id,
+                'h4' as source,
+                md5_hex(concat(time_slice(timestamp, {minutes}, 'minute'), trunc(latitude, {truncation}), trunc(longitude, {truncation}))) as rh,
+                count(1) over (partition by rh) as dupes
+            from
+                singularity.public.h4_maid_clustered
+            where
+                (idfa like '{device_id[:3].lower()}%' or idfa like '{device_id[:3].upper()}%') and
+                lower(idfa) = '{device_id.lower()}'
+            union all
+            select 
+                lower(idfa) as id, 
+                timestamp,
+                latitude,
+                longitude,
+                supply_id,
+                'purge' as source,
+                md5_hex(concat(time_slice(timestamp, {minutes}, 'minute'), trunc(latitude, {truncation}), trunc(longitude, {truncation}))) as rh,
+                count(1) over (partition by rh) as dupes
+            from
+                singularity.public.locations_purge
+            where
+                (idfa like '{device_id[:3].lower()}%' or idfa like '{device_id[:3].upper()}%') and
+                lower(idfa) = '{device_id.lower()}'
+        ), filtered_data as (
+            select
+                id,
+                timestamp,
+                latitude,
+                longitude,
+                supply_id,
+                source,
+                rh,
+                dupes - 1 as duplicates
+            from
+                all_data
+        ), enriched_data as (
+            select
+                id,
+                timestamp,
+                latitude,
+                longitude,
+                supply_id,
+                source,
+                rh,
+                duplicates,
+                datediff('minutes', lag(timestamp) over (order by timestamp, latitude, longitude), timestamp) as min_since_last_locate,
+                haversine(latitude, longitude, lag(latitude) over (order by timestamp, latitude, longitude), lag(longitude) over (order by timestamp, latitude, longitude)) as km_since_last_locate
+            from
+                filtered_data
+        ), grouped_data as (
+            select
+                *,
+                sum(case when km_since_last_locate > {km_threshold} then 1 else 0 end) over (order by timestamp, latitude, longitude) as segment
+            from
+                enriched_data
+        ), twice_enriched as (
+            select
+                id,
+                timestamp,
+                latitude,
+                longitude,
+                supply_id,
+                source,
+                segment,
+                first_value(latitude) over (partition by segment order by timestamp, latitude, longitude) as start_lat,
+                last_value(latitude) over (partition by segment order by timestamp, latitude, longitude) as end_lat,
+                first_value(longitude) over (partition by segment order by timestamp, latitude, longitude) as start_lon,
+                last_value(longitude) over (partition by segment order by timestamp, latitude, longitude) as end_lon,
+                first_value(timestamp) over (partition by segment order by timestamp, latitude, longitude) as start_time,
+                last_value(timestamp) over (partition by segment order by timestamp, latitude, longitude) as end_time,
+                sum(min_since_last_locate) over (partition by segment) as total_mins,
+                sum(km_since_last_locate) over (partition by segment) as total_kms,
+                first_value(km_since_last_locate) over (partition by segment order by timestamp, latitude, longitude) as km_since_last_segment,
+                first_value(min_since_last_locate) over (partition by segment order by timestamp, latitude, longitude) as min_since_last_segment,
+                sum(duplicates) over (partition by segment) as segment_duplicates,
+                count(distinct date_trunc('mins', timestamp)) over (partition by segment) as covered_segment_mins
+            from
+                grouped_data
+        )
+"""
+
+
+def locates_sql(device_id: str, minutes: int, truncation: int, km_threshold: int) -> str:
+    # One row per raw locate with its segment aggregates repeated on every row
+    return _segments_cte(device_id, minutes, truncation, km_threshold) + """
+        select
+            id,
+            timestamp,
+            latitude,
+            longitude,
+            supply_id,
+            source,
+            segment,
+            segment_duplicates as locates,
+            total_mins - min_since_last_segment as min_seen,
+            (covered_segment_mins / (min_seen + 1)) * 100 as coverage_percent,
+            total_kms - km_since_last_segment as km_travelled,
+            start_lat,
+            start_lon,
+            start_time,
+            end_lat,
+            end_lon,
+            end_time
+        from
+            twice_enriched
+"""
+
+
+def segments_sql(device_id: str, minutes: int, truncation: int, km_threshold: int) -> str:
+    # The same aggregates as group_segments(), computed in the warehouse so only one row per segment comes back
+    return _segments_cte(device_id, minutes, truncation, km_threshold) + """
+        select
+            segment,
+            count(id) as id,
+            min(timestamp) as timestamp,
+            max(start_lat) as start_lat,
+            max(start_lon) as start_lon,
+            max(start_time) as start_time,
+            max(end_lat) as end_lat,
+            max(end_lon) as end_lon,
+            max(end_time) as end_time,
+            max(segment_duplicates) as locates,
+            max(total_mins - min_since_last_segment) as min_seen,
+            max((covered_segment_mins / (total_mins - min_since_last_segment + 1)) * 100) as coverage_percent,
+            max(total_kms - km_since_last_segment) as km_travelled,
+            count(distinct supply_id) as supply_id,
+            max(case when supply_id = '742' then 1 else 0 end) as has_742
+        from
+            twice_enriched
+        group by
+            segment
+        order by
+            segment
+        """
+
+
+def snowflake_runner():
+    # The snowflake client is only imported once a device actually needs querying
+    from sharehousepy import SnowflakeConnection, Query
+
+    sf_con = SnowflakeConnection(
+        username=st.secrets["database"]["SF_USERNAME"], 
+        password=st.secrets["database"]["SF_PASSWORD"],
+        account=st.secrets["database"]["SF_ACCOUNT"],
+        database=st.secrets["database"]["SF_DATABASE"],
+        schema=st.secrets["database"]["SF_SCHEMA"],
+        warehouse_sm=st.secrets["database"]["SF_WAREHOUSE_LG"],
+        warehouse_lg=st.secrets["database"]["SF_WAREHOUSE_LG"],
+        geo_table=st.secrets["database"]["SF_GEO_TABLE"],
+        id_table=st.secrets["database"]["SF_ID_TABLE"],
+    )
+
+    def _run(sql: str):
+        q = Query(query=sql)
+        sf_con.run(q)
+        return q.results
+
+    return _run
+
+
+def group_segments(df: pd.DataFrame) -> pd.DataFrame:
+    return df.groupby(['segment']).agg({
+        'id': 'count',  # Count total rows
+        'timestamp': 'min',
+        'start_lat': 'max',
+        'start_lon': 'max',
+        'start_time': 'max',
+        'end_lat': 'max',
+        'end_lon': 'max',
+        'end_time': 'max',
+        'locates': 'max',
+        'min_seen': 'max',
+        'coverage_percent': 'max',
+        'km_travelled': 'max',
+        'fraud': 'max',
+        'supply_id': pd.Series.nunique,
+        'has_742': 'max'
+    }).reset_index()
+
+
+def locates_frame(rows) -> pd.DataFrame:
+    df = pd.DataFrame(rows, columns=LOCATE_COLUMNS)
+
+    # Convert the time column to datetime
+    df['timestamp'] = pd.to_datetime(df['timestamp'])
+    
+    # Create 'fraud' column
+    df['fraud'] = None
+
+    # Use 742 as source of truth and automark
+    df['has_742'] = 0
+    df.loc[df['supply_id'] == '742', 'has_742'] = 1  
+    df.loc[df['has_742'] == 1, 'fraud'] = True  
+    return df
+
+
+def segments_frame(rows) -> pd.DataFrame:
+    segment_df = pd.DataFrame(rows, columns=SEGMENT_COLUMNS)
+    segment_df['timestamp'] = pd.to_datetime(segment_df['timestamp'])
+
+    # Same 742 automark as locates_frame, applied per segment
+    segment_df['fraud'] = None
+    segment_df.loc[segment_df['has_742'] == 1, 'fraud'] = True
+    return segment_df[['segment', 'id', 'timestamp', 'start_lat', 'start_lon', 'start_time', 'end_lat', 'end_lon', 'end_time', 'locates', 'min_seen', 'coverage_percent', 'km_travelled', 'fraud', 'supply_id', 'has_742']]
+
+
+def _start_fetch(pending: dict):
+    def _fetch():
+        try:
+            pending['rows'] = pending['run'](pending['sql'])
+        except Exception as e:
+            pending['error'] = e
+            print(f'error fetching locates: {e}')
+
+    pending['rows'], pending['error'] = None, None
+    pending['attempts'] += 1
+    pending['thread'] = threading.Thread(target=_fetch, daemon=True)
+    pending['thread'].start()
+
+
+def fetch_locates_async(run, sql: str) -> dict:
+    # Pull the raw locates in the background, sync_locates() picks them up on a later rerun
+    pending = {'run': run, 'sql': sql, 'attempts': 0}
+    _start_fetch(pending)
+    return pending
+
+
+def retry_locates():
+    pending = st.session_state.get('pending_locates')
+    if pending is not None and not pending['thread'].is_alive():
+        _start_fetch(pending)
+
+
+def locates_failed() -> bool:
+    # The fetch gave up, nothing can be saved until it is retried and succeeds
+    pending = st.session_state.get('pending_locates')
+    return pending is not None and not pending['thread'].is_alive() and pending['error'] is not None and pending['attempts'] >= LOCATE_ATTEMPTS
+
+
+def sync_locates(block: bool = False) -> bool:
+    pending = st.session_state.get('pending_locates')
+    if pending is None:
+        return st.session_state.get('df') is not None
+
+    if block:
+        pending['thread'].join()
+    if pending['thread'].is_alive():
+        return False
+
+    if pending['error'] is not None:
+        # Keep the pending fetch so it can be retried, a few times on its own and then on request
+        if pending['attempts'] < LOCATE_ATTEMPTS:
+            _start_fetch(pending)
+        return False
+
+    # Labels made while the locates were loading are already in the session's overlay
+    st.session_state['pending_locates'] = None
+    st.session_state['df'] = locates_frame(pending['rows'])
+    st.session_state['version'] = st.session_state.get('version', 0) + 1
+    if write_df_async():
+        st.session_state['annotations'] = {}
+    # the device was finished while the locates were loading, credit it now they are saved
+    if st.session_state.pop('meta_pending', False):
+        add_meta()
+    return True
@@ -0,0 +1,112 @@
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+
+# Array versions of the distance, bearing and speed math used across the app. Everything takes
+# and returns numpy arrays, missing coordinates or times come out as NaN rather than raising.
+#
+#   python -m helpers.geo --pairs 100000
+EARTH_RADIUS_KM = 6371.0088  # mean radius, same as the haversine package
+KM_TO_MILES = 0.621371
+MIN_MINUTES = 1  # anything under a minute apart counts as one minute
+
+
+def haversine(lat1, lon1, lat2, lon2) -> np.ndarray:
+    # Great circle km between (lat1, lon1) and (lat2, lon2)
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype='float64')) for x in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def bearing(lat1, lon1, lat2, lon2) -> np.ndarray:
+    # Initial bearing in degrees [0, 360) heading from (lat1, lon1) to (lat2, lon2)
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype='float64')) for x in (lat1, lon1, lat2, lon2))
+    y = np.sin(lon2 - lon1) * np.cos(lat2)
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(lon2 - lon1)
+    return np.degrees(np.arctan2(y, x)) % 360
+
+
+def minutes_between(ends, starts) -> np.ndarray:
+    # Minutes from each end to the matching start, NaN where either is missing
+    ends = pd.to_datetime(pd.Series(ends), utc=True).dt.tz_convert(None).to_numpy()
+    starts = pd.to_datetime(pd.Series(starts), utc=True).dt.tz_convert(None).to_numpy()
+    return (starts - ends) / np.timedelta64(1, 'm')
+
+
+def speed_kmh(km, minutes) -> np.ndarray:
+    # Zero, negative and sub minute gaps all use MIN_MINUTES so every panel agrees, NaN stays NaN
+    minutes = np.maximum(np.asarray(minutes, dtype='float64'), MIN_MINUTES)
+    return np.asarray(km, dtype='float64') / (minutes / 60)
+
+
+def segment_gaps(segment_df: pd.DataFrame) -> np.ndarray:
+    # Km from the end of each segment to the start of the next, 0 for the first segment
+    if segment_df.empty:
+        return np.empty(0)
+    return np.concatenate([[0.0], haversine(
+        segment_df['end_lat'].to_numpy()[:-1],
+        segment_df['end_lon'].to_numpy()[:-1],
+        segment_df['start_lat'].to_numpy()[1:],
+        segment_df['start_lon'].to_numpy()[1:]
+    )])
+
+
+def hops(segment_df: pd.DataFrame, previous: np.ndarray, positions: np.ndarray = None) -> dict:
+    # Distance, time, speed and heading from the end of segment `previous[i]` to the start of
+    # segment `positions[i]` (row positions), NaN where previous is -1
+    if positions is None:
+        positions = np.arange(len(segment_df))
+    positions = np.asarray(positions, dtype='int64')
+    previous = np.asarray(previous, dtype='int64')
+    has_previous = previous >= 0
+
+    result = {name: np.full(len(positions), np.nan) for name in ['km', 'minutes', 'kmh', 'bearing']}
+    if has_previous.any():
+        current = positions[has_previous]
+        before = previous[has_previous]
+        coords = [segment_df[column].to_numpy(dtype='float64') for column in ['end_lat', 'end_lon', 'start_lat', 'start_lon']]
+        points = (coords[0][before], coords[1][before], coords[2][current], coords[3][current])
+
+        km = haversine(*points)
+        minutes = minutes_between(segment_df['end_time'].to_numpy()[before], segment_df['start_time'].to_numpy()[current])
+        result['km'][has_previous] = km
+        result['minutes'][has_previous] = minutes
+        result['kmh'][has_previous] = speed_kmh(km, minutes)
+        result['bearing'][has_previous] = bearing(*points)
+    return result
+
+
+def benchmark(pairs: int = 100_000, seed: int = 0) -> pd.DataFrame:
+    # Against the haversine package the app used before, one pair at a time and vectorized
+    from haversine import haversine as haversine_pair, haversine_vector
+
+    rng = np.random.default_rng(seed)
+    lat1, lat2 = rng.uniform(-90, 90, (2, pairs))
+    lon1, lon2 = rng.uniform(-180, 180, (2, pairs))
+    expected = np.array([haversine_pair((a, b), (c, d)) for a, b, c, d in zip(lat1[:1000], lon1[:1000], lat2[:1000], lon2[:1000])])
+
+    def _time(fn, n):
+        started = time.perf_counter()
+        result = fn()
+        return (time.perf_counter() - started) / n * pairs, result
+
+    runs = {
+        'haversine() per pair': _time(lambda: [haversine_pair((a, b), (c, d)) for a, b, c, d in zip(lat1[:1000], lon1[:1000], lat2[:1000], lon2[:1000])], 1000),
+        'haversine_vector': _time(lambda: haversine_vector(np.column_stack([lat1, lon1]), np.column_stack([lat2, lon2])), pairs),
+        'geo.haversine': _time(lambda: haversine(lat1, lon1, lat2, lon2), pairs)
+    }
+    return pd.DataFrame([{
+        'method': method,
+        'pairs': pairs,
+        'seconds': seconds,
+        'max_abs_err_km': float(np.max(np.abs(np.asarray(result)[:1000] - expected)))
+    } for method, (seconds, result) in runs.items()])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark the vectorized haversine against the haversine package')
+    parser.add_argument('--pairs', type=int, default=100_000, help='coordinate pairs per run (per pair timing is extrapolated from 1,000)')
+    args = parser.parse_args()
+    print(benchmark(args.pairs).to_string(index=False, float_format=lambda x: f'{x:,.6f}'))
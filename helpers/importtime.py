@@ -0,0 +1,85 @@
+import os
+import re
+import sys
+import json
+import argparse
+import subprocess
+
+
+# Cold start check: imports app.py in a fresh interpreter with -X importtime and fails when
+# the import takes longer than the budget or pulls in a dependency that should be deferred
+# to the code path that uses it.
+#
+#   python -m helpers.importtime --budget-ms 500
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFERRED = [
+    'pydeck',         # render_map, once a device is loaded
+    'plotly',         # render_sidebar / render_overview, once a device is loaded
+    'streamlit_shortcuts',
+    'streamlit_extras',
+    'sharehousepy',   # snowflake_runner
+    'snowflake',
+    's3fs',           # only where a file is read or written
+    'haversine',
+    'pyarrow',        # parquet export
+]
+
+_LINE = re.compile(r'import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( +)(\S+)')
+
+
+def measure() -> dict:
+    # streamlit and pandas are needed on every path and are imported first, so what they pull
+    # in themselves (streamlit uses plotly, pandas loads pyarrow when installed) isn't blamed on app.py
+    code = (
+        'import json, sys; import streamlit; import pandas; before = set(sys.modules); import app; '
+        f'print(json.dumps(sorted({{m.split(".")[0] for m in set(sys.modules) - before}} & set({DEFERRED!r}))))'
+    )
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr[-2000:])
+
+    # -X importtime writes one line per module after its children: self us | cumulative us | name,
+    # indented two spaces per nesting level
+    modules = []
+    for line in result.stderr.splitlines():
+        match = _LINE.match(line)
+        if match:
+            modules.append({
+                'module': match.group(4),
+                'cumulative_ms': int(match.group(2)) / 1000,
+                'depth': (len(match.group(3)) - 1) // 2
+            })
+
+    index = {m['module']: i for i, m in enumerate(modules) if m['depth'] == 0}
+    app = index['app']
+    first = max(i for i in index.values() if i < app) + 1 if any(i < app for i in index.values()) else 0
+    children = [m for m in modules[first:app] if m['depth'] == 1]
+    return {
+        'baseline_ms': modules[index['streamlit']]['cumulative_ms'] + modules[index['pandas']]['cumulative_ms'],
+        'app_ms': modules[app]['cumulative_ms'],
+        'heaviest': sorted(children, key=lambda m: -m['cumulative_ms'])[:10],
+        'loaded_deferred': json.loads(result.stdout.strip().splitlines()[-1])
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='measure the cold import time of app.py')
+    parser.add_argument('--budget-ms', type=float, default=None, help='fail when importing app (on top of streamlit and pandas) takes longer than this')
+    args = parser.parse_args()
+
+    report = measure()
+    print(f"import streamlit + pandas: {report['baseline_ms']:,.0f}ms")
+    print(f"import app: {report['app_ms']:,.0f}ms")
+    for m in report['heaviest']:
+        print(f"  {m['module']:<30} {m['cumulative_ms']:>8,.0f}ms")
+
+    failed = False
+    if report['loaded_deferred']:
+        print(f"deferred dependencies imported at startup: {', '.join(report['loaded_deferred'])}")
+        failed = True
+    if args.budget_ms is not None and report['app_ms'] > args.budget_ms:
+        print(f"over budget of {args.budget_ms:,.0f}ms")
+        failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,357 @@
+import os
+import time
+import random
+import shutil
+import resource
+import argparse
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+
+# Drives N concurrent simulated annotators through app.py with streamlit's AppTest, one process each,
+# against a local directory standing in for S3 and a synthetic Snowflake runner. A real server runs
+# every session in one process, so rss_mb there is a whole process per session and can't show what
+# sessions share. The same sessions are then also opened one after another in a single process,
+# all kept alive, to measure what each extra session adds.
+#
+#   python -m helpers.loadtest --sessions 8 --segments 2000 --steps 50
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+BUCKET = 'a6dev-mltraining'
+
+SECRETS = {
+    'aws': {'PUBLIC_KEY': 'local', 'PRIVATE_KEY': 'local'},
+    'database': {key: 'local' for key in ['SF_USERNAME', 'SF_PASSWORD', 'SF_ACCOUNT', 'SF_DATABASE', 'SF_SCHEMA', 'SF_WAREHOUSE_LG', 'SF_GEO_TABLE', 'SF_ID_TABLE']}
+}
+
+
+class LocalS3:
+    # The subset of s3fs.S3FileSystem the app uses, backed by a local directory
+
+    def __init__(self, root: str, latency: float = 0.0):
+        self.root = root
+        self.latency = latency
+
+    def _local(self, path: str) -> str:
+        return os.path.join(self.root, path.replace('s3://', '', 1))
+
+    def open(self, path: str, mode: str = 'rb'):
+        time.sleep(self.latency)
+        local = self._local(path)
+        if mode[0] in 'wa':
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+        return open(local, mode)
+
+    def info(self, path: str) -> dict:
+        stat = os.stat(self._local(path))
+        return {'ETag': f'"{stat.st_mtime_ns}-{stat.st_size}"', 'LastModified': stat.st_mtime, 'size': stat.st_size}
+
+    def invalidate_cache(self, path=None):
+        pass
+
+    def call_s3(self, method: str, **kwargs) -> dict:
+        # only put_object, answering with the etag of what was written like S3 does
+        assert method == 'put_object', method
+        time.sleep(self.latency)
+        path = f"{kwargs['Bucket']}/{kwargs['Key']}"
+        local = self._local(path)
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(local), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            shutil.copyfileobj(kwargs['Body'], f)
+        # the etag of this write, the rename keeps mtime and size
+        stat = os.stat(tmp_path)
+        os.replace(tmp_path, local)
+        return {'ETag': f'"{stat.st_mtime_ns}-{stat.st_size}"'}
+
+
+def synthetic_device(device_id: str, segments: int = 1000, locates_per_segment: int = 20, seed: int = 0) -> pd.DataFrame:
+    # One row per locate in the raw_input layout, segments are ~50km hops of a random walk
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(1, 2 * locates_per_segment, segments)
+    segment = np.repeat(np.arange(segments), counts)
+    n = len(segment)
+
+    centers_lat = 40 + np.cumsum(rng.choice([-0.5, 0.5], segments))
+    centers_lon = -100 + np.cumsum(rng.choice([-0.5, 0.5], segments))
+    timestamp = pd.Timestamp('2024-01-01') + pd.to_timedelta(np.cumsum(rng.integers(1, 600, n)), unit='s')
+
+    df = pd.DataFrame({
+        'id': device_id,
+        'timestamp': timestamp,
+        'latitude': centers_lat[segment] + rng.normal(0, 0.001, n),
+        'longitude': centers_lon[segment] + rng.normal(0, 0.001, n),
+        'supply_id': rng.choice(['1', '2', '3', '742'], n, p=[0.5, 0.3, 0.199, 0.001]),
+        'source': rng.choice(['h4', 'purge'], n),
+        'segment': segment,
+    })
+    first = df.groupby('segment').transform('first')
+    last = df.groupby('segment').transform('last')
+    seconds = (last['timestamp'] - first['timestamp']).dt.total_seconds()
+
+    df['locates'] = df.groupby('segment')['segment'].transform('size') + rng.integers(0, 5, segments)[segment]
+    df['min_seen'] = seconds / 60
+    df['coverage_percent'] = rng.uniform(0, 100, segments)[segment]
+    df['km_travelled'] = rng.uniform(0, 5, segments)[segment]
+    df['start_lat'], df['start_lon'], df['start_time'] = first['latitude'], first['longitude'], first['timestamp']
+    df['end_lat'], df['end_lon'], df['end_time'] = last['latitude'], last['longitude'], last['timestamp']
+    df['fraud'] = None
+    df['has_742'] = (df['supply_id'] == '742').astype(int)
+    df.loc[df['has_742'] == 1, 'fraud'] = True
+    return df
+
+
+def snowflake_standin(frames: dict, latency: float = 0.0):
+    from helpers.extract import LOCATE_COLUMNS, SEGMENT_COLUMNS, group_segments
+
+    def _runner():
+        def _run(sql: str):
+            time.sleep(latency)
+            device_id = next(d for d in frames if f"'{d}'" in sql)
+            df = frames[device_id]
+            if 'group by' in sql:
+                return group_segments(df)[SEGMENT_COLUMNS].values.tolist()
+            return df[LOCATE_COLUMNS].values.tolist()
+        return _run
+
+    return _runner
+
+
+def device_ids(count: int) -> list:
+    return [f'00000000-0000-0000-0000-{i:012d}' for i in range(count)]
+
+
+def install_standins(root: str, frames: dict, s3_latency: float = 0.0, sf_latency: float = 0.0) -> list:
+    # Swap in the stand-ins and track every background write the app starts
+    import s3fs
+    from helpers import cache, extract, misc
+
+    cache.CACHE_DIR = os.path.join(root, 'cache')
+    s3 = LocalS3(root, s3_latency)
+    backlog = []
+    write_df_async = misc.write_df_async
+
+    def _tracked_write():
+        thread = write_df_async()
+        if thread is not None:
+            backlog.append(thread)
+        return thread
+
+    s3fs.S3FileSystem = lambda **kwargs: s3
+    extract.snowflake_runner = snowflake_standin(frames, sf_latency)
+    misc.write_df_async = _tracked_write
+    extract.write_df_async = _tracked_write
+    return backlog
+
+
+def _frame_bytes(at) -> int:
+    total = 0
+    for name in ['df', 'segment_df']:
+        if name in at.session_state and isinstance(at.session_state[name], pd.DataFrame):
+            total += int(at.session_state[name].memory_usage(deep=True).sum())
+    return total
+
+
+def _click(at, label: str) -> bool:
+    button = next((b for b in at.sidebar.button if b.label == label), None)
+    if button is None:
+        return False
+    button.click()
+    return True
+
+
+def _rss_bytes() -> int:
+    # current resident size, ru_maxrss only ever grows
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def _open_session(index: int, device_id: str, config: dict, run=None):
+    # Load device_id and walk through config['steps'] actions, run(at) performs each rerun
+    from streamlit.testing.v1 import AppTest
+
+    rng = random.Random(index)
+    at = AppTest.from_file(APP, default_timeout=config['timeout'])
+    at.secrets.update(SECRETS)
+
+    def _rerun():
+        if run is None:
+            at.run()
+        else:
+            run(at)
+
+    _rerun()
+    at.sidebar.text_input[0].input(f'load{index}')
+    at.sidebar.text_input[1].input(device_id)
+    if not config['summary_first']:
+        at.sidebar.checkbox[0].uncheck()
+    _click(at, 'search')
+    _rerun()
+
+    # A mix that roughly matches a real annotator, mostly labeling good with some navigation
+    for _ in range(config['steps']):
+        if not _click(at, rng.choices(['↑', '↓', '→', '←'], weights=[70, 10, 15, 5])[0]):
+            # the page failed to render its controls, already counted in errors
+            break
+        _rerun()
+    return at
+
+
+def run_session(index: int, device_id: str, config: dict) -> dict:
+    # Runs in its own process, AppTest swaps a global mock runtime so sessions can't share one
+    ids = device_ids(config['devices'])
+    frames = {d: synthetic_device(d, config['segments'], config['locates_per_segment'], seed=i) for i, d in enumerate(ids)}
+    backlog = install_standins(config['root'], frames, config['s3_latency'], config['sf_latency'])
+
+    latencies = []
+    errors = 0
+    peak_backlog = 0
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def _timed_run(at):
+        nonlocal errors, peak_backlog
+        started = time.perf_counter()
+        at.run()
+        latencies.append(time.perf_counter() - started)
+        errors += len(at.exception)
+        peak_backlog = max(peak_backlog, sum(t.is_alive() for t in backlog))
+
+    at = _open_session(index, device_id, config, _timed_run)
+
+    pending = sum(t.is_alive() for t in backlog)
+    started = time.perf_counter()
+    for thread in backlog:
+        thread.join()
+
+    return {
+        'session': index,
+        'device': device_id,
+        'reruns': len(latencies),
+        'p50': np.percentile(latencies, 50),
+        'p90': np.percentile(latencies, 90),
+        'p99': np.percentile(latencies, 99),
+        'frames_mb': _frame_bytes(at) / 1024 ** 2,
+        'rss_mb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024,
+        'writes': len(backlog),
+        'peak_backlog': peak_backlog,
+        'pending_at_end': pending,
+        'drain_s': time.perf_counter() - started,
+        'errors': errors,
+        'latencies': latencies
+    }
+
+
+def run_sequential(sessions: int, config: dict) -> pd.DataFrame:
+    # Opens the sessions one after another in this process and keeps them all alive, the way a
+    # server holds them, recording what each one adds to the resident size
+    import gc
+    from helpers import shared
+
+    ids = device_ids(config['devices'])
+    frames = {d: synthetic_device(d, config['segments'], config['locates_per_segment'], seed=i) for i, d in enumerate(ids)}
+    backlog = install_standins(config['root'], frames, config['s3_latency'], config['sf_latency'])
+    del frames
+
+    opened = []
+    rows = []
+    gc.collect()
+    rss = _rss_bytes()
+    for index in range(sessions):
+        opened.append(_open_session(index, ids[index % len(ids)], config))
+        for thread in backlog:
+            thread.join()
+        gc.collect()
+        before, rss = rss, _rss_bytes()
+        rows.append({
+            'sessions': index + 1,
+            'device': ids[index % len(ids)],
+            'shared_devices': shared.devices(),
+            'rss_mb': rss / 1024 ** 2,
+            'added_mb': (rss - before) / 1024 ** 2,
+            'errors': len(opened[-1].exception)
+        })
+    return pd.DataFrame(rows)
+
+
+def load_test(sessions: int = 4, devices: int = None, segments: int = 1000, locates_per_segment: int = 20, steps: int = 25,
+              s3_latency: float = 0.0, sf_latency: float = 0.0, seed_s3: bool = True, summary_first: bool = True, timeout: float = 120,
+              sequential: bool = True) -> pd.DataFrame:
+    root = tempfile.mkdtemp(prefix='loadtest-')
+    config = {
+        'root': root,
+        'devices': devices or sessions,
+        'segments': segments,
+        'locates_per_segment': locates_per_segment,
+        'steps': steps,
+        's3_latency': s3_latency,
+        'sf_latency': sf_latency,
+        'summary_first': summary_first,
+        'timeout': timeout
+    }
+    ids = device_ids(config['devices'])
+
+    s3 = LocalS3(root)
+    with s3.open(f's3://{BUCKET}/annotations.csv', 'w') as f:
+        f.write('device_id,user_id,seconds,locates,segments\n')
+    if seed_s3:
+        for i, device_id in enumerate(ids):
+            with s3.open(f's3://{BUCKET}/raw_input/4/1/10/{device_id}.csv', 'w') as f:
+                synthetic_device(device_id, segments, locates_per_segment, seed=i).to_csv(f, index=False)
+
+    started = time.perf_counter()
+    try:
+        # fork so every session shares the already imported modules, like workers on one box
+        with ProcessPoolExecutor(max_workers=sessions, mp_context=multiprocessing.get_context('fork')) as pool:
+            futures = [pool.submit(run_session, i, ids[i % len(ids)], config) for i in range(sessions)]
+            results = [future.result() for future in futures]
+        elapsed = time.perf_counter() - started
+        if sequential:
+            # its own fresh process so the concurrent run doesn't skew the resident size
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('fork')) as pool:
+                one_process = pool.submit(run_sequential, sessions, config).result()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    report = pd.DataFrame([{k: v for k, v in r.items() if k != 'latencies'} for r in results])
+    latencies = np.concatenate([r['latencies'] for r in results])
+    print(report.to_string(index=False, float_format=lambda x: f'{x:,.3f}'))
+    print(f"rerun latency p50 {np.percentile(latencies, 50):.3f}s  p90 {np.percentile(latencies, 90):.3f}s  p99 {np.percentile(latencies, 99):.3f}s")
+    print(f"process memory per forked session mean {report['rss_mb'].mean():,.0f}MB  max {report['rss_mb'].max():,.0f}MB")
+    print(f"writes {report['writes'].sum()}, peak backlog {report['peak_backlog'].max()}, pending at end {report['pending_at_end'].sum()}")
+    print(f"total {elapsed:,.1f}s")
+    if sequential:
+        print()
+        print(one_process.to_string(index=False, float_format=lambda x: f'{x:,.1f}'))
+        extra = one_process['added_mb'].iloc[1:]
+        print(f"one process: first session {one_process['added_mb'].iloc[0]:,.0f}MB, each extra session {extra.mean() if len(extra) else float('nan'):,.1f}MB on average")
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='load test the annotation app with simulated concurrent sessions')
+    parser.add_argument('--sessions', type=int, default=4, help='concurrent simulated annotators')
+    parser.add_argument('--devices', type=int, default=None, help='distinct devices shared across sessions (default one per session)')
+    parser.add_argument('--segments', type=int, default=1000, help='segments per synthetic device')
+    parser.add_argument('--locates', type=int, default=20, help='average locates per segment')
+    parser.add_argument('--steps', type=int, default=25, help='navigation/labeling actions per session')
+    parser.add_argument('--s3-latency', type=float, default=0.0, help='seconds added to every S3 stand-in call')
+    parser.add_argument('--sf-latency', type=float, default=0.0, help='seconds added to every Snowflake stand-in query')
+    parser.add_argument('--query', action='store_true', help='start with an empty bucket so devices load through the Snowflake stand-in')
+    parser.add_argument('--full-query', action='store_true', help='with --query, pull raw locates up front instead of summary first')
+    parser.add_argument('--no-sequential', action='store_true', help='skip opening the sessions one after another in a single process')
+    args = parser.parse_args()
+    load_test(
+        sessions=args.sessions,
+        devices=args.devices,
+        segments=args.segments,
+        locates_per_segment=args.locates,
+        steps=args.steps,
+        s3_latency=args.s3_latency,
+        sf_latency=args.sf_latency,
+        seed_s3=not args.query,
+        summary_first=not args.full_query,
+        sequential=not args.no_sequential
+    )
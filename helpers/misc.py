@@ -1,4 +1,3 @@
-import s3fs
 import streamlit as st
 import pandas as pd
 from typing import List
@@ -6,12 +5,19 @@ import math
 import time
 import csv
 import threading
-from haversine import haversine
+from helpers import cache, shared
 
 
    
 def write_df_async():
+    import s3fs
+
     df = st.session_state['df']
+    if df is None:
+        # raw locates still loading, sync_locates writes once they land
+        return None
+    # snapshot of this session's labels over the (possibly shared) frame
+    df = shared.labeled(df)
     truncation = st.session_state['truncation']
     mins = st.session_state['minutes']
     threshold = st.session_state['km_threshold']
@@ -28,8 +34,8 @@ def write_df_async():
 
             s3_path = f"s3://a6dev-mltraining/raw_input/{truncation}/{mins}/{threshold}/{device_id}.csv"
 
-            with s3.open(s3_path, 'w') as f:
-                df.to_csv(f, index=False)
+            # Upload through the local cache so a refresh on this box is a local read
+            cache.put(s3, s3_path, lambda f: df.to_csv(f, index=False))
             print(f"file updated: {s3_path}")
         except Exception as e:
             print(f'error writing csv: {e}')
@@ -56,7 +62,7 @@ def format_minutes(minutes: int) -> str:
     
 def alt_format_minutes(minutes: int) -> str:
     if math.isnan(minutes):
-        return "<1m"
+        return "<1", 'mins'
     days, _ = divmod(minutes, 1440)  # 1440 minutes in a day
     hours, _ = divmod(minutes, 60)   # 60 minutes in an hour
     if days > 0:
@@ -87,12 +93,9 @@ def human_format(num):
     # add more suffixes if you need them
     return '%.0f%s' % (num, ['', 'K', 'M', 'G', 'T', 'P'][magnitude])
 
-# Calculate distance using Haversine formula
-def calculate_distance(lat1, lon1, lat2, lon2):
-    return haversine((lat1, lon1), (lat2, lon2))
-
-
 def add_meta() -> bool:
+    import s3fs
+
     s3 = s3fs.S3FileSystem(
         key=st.secrets["aws"]["PUBLIC_KEY"],
         secret=st.secrets["aws"]["PRIVATE_KEY"]
@@ -117,15 +120,38 @@ def calculate_segments(segment: int, max_segments: int) -> List[int]:
     return segments
 
 
-   
-def format_speed(km, min):
-    if math.isnan(km) or math.isnan(min):
-        return f"0.0km/m"
-    elif min <= 1:
-        return f"{km:,.0f}km/m"
-    else:
-        return f"{km/min:,.0f}km/m"
-    
+
+def keyboard_shortcuts(shortcuts: dict):
+    # {combo: button label}, e.g. {'Shift+ArrowRight': '⇧→'}. Unlike streamlit_shortcuts every
+    # modifier has to match exactly, so Shift+→ doesn't also click the plain → button.
+    import json
+    import streamlit.components.v1 as components
+
+    conditions = []
+    for combo, label in shortcuts.items():
+        *modifiers, key = combo.split('+')
+        checks = [f"e.key === {json.dumps(key)}"] + [f"{'' if m in modifiers else '!'}e.{m.lower()}Key" for m in ['Ctrl', 'Shift', 'Alt', 'Meta']]
+        conditions.append(f"if ({' && '.join(checks)}) {{ label = {json.dumps(label)}; }}")
+
+    # One listener on the page, replacing the one registered by the previous render
+    components.html(f"""
+    <script>
+    const doc = window.parent.document;
+    if (doc.annotatorShortcuts) {{ doc.removeEventListener('keydown', doc.annotatorShortcuts); }}
+    doc.annotatorShortcuts = function(e) {{
+        // leave keys typed into inputs (arrows step number inputs) to the input
+        const target = e.target;
+        if (target && (['INPUT', 'TEXTAREA', 'SELECT'].includes(target.tagName) || target.isContentEditable)) {{ return; }}
+        let label = null;
+        {' else '.join(conditions)}
+        if (label === null) {{ return; }}
+        const button = Array.from(doc.querySelectorAll('button')).find(el => el.innerText === label);
+        if (button) {{ e.preventDefault(); button.click(); }}
+    }};
+    doc.addEventListener('keydown', doc.annotatorShortcuts);
+    </script>
+    """, height=0, width=0)
+
 
 def assign_color(fraud):
     if pd.isna(fraud):
@@ -0,0 +1,84 @@
+import streamlit as st
+import pandas as pd
+import numpy as np
+from helpers import shared
+
+
+# Whole device overview. Every segment is assigned a time bin (by its first timestamp) and a
+# space bin (by its start point) once per load, and label status counts are kept per bin so a
+# label change only touches the bins its segments fall in.
+TIME_BINS = 120
+SPACE_BINS = 24  # per axis
+STATUS = ['unlabeled', 'good', 'bad']
+
+
+def status_codes(fraud) -> np.ndarray:
+    fraud = pd.Series(fraud, dtype=object)
+    codes = np.zeros(len(fraud), dtype='int8')
+    codes[(fraud == True).to_numpy()] = 1
+    codes[(fraud == False).to_numpy()] = 2
+    return codes
+
+
+def _bins(values: np.ndarray, count: int):
+    edges = np.linspace(np.nanmin(values), np.nanmax(values), count + 1) if len(values) else np.zeros(count + 1)
+    return edges, np.clip(np.searchsorted(edges, values, side='right') - 1, 0, count - 1)
+
+
+def _counts(bins: np.ndarray, status: np.ndarray, count: int) -> np.ndarray:
+    counts = np.zeros((count, len(STATUS)), dtype='int64')
+    np.add.at(counts, (bins, status), 1)
+    return counts
+
+
+def build(segment_df: pd.DataFrame, fraud: pd.Series) -> dict:
+    times = pd.to_datetime(segment_df['timestamp'], utc=True).astype('int64').to_numpy()
+    time_edges, time_bin = _bins(times, TIME_BINS)
+    lat_edges, lat_bin = _bins(segment_df['start_lat'].to_numpy(dtype='float64'), SPACE_BINS)
+    lon_edges, lon_bin = _bins(segment_df['start_lon'].to_numpy(dtype='float64'), SPACE_BINS)
+    space_bin = lat_bin * SPACE_BINS + lon_bin
+    status = status_codes(fraud)
+
+    return {
+        'time_edges': time_edges,
+        'lat_edges': lat_edges,
+        'lon_edges': lon_edges,
+        'time_bin': time_bin,
+        'space_bin': space_bin,
+        'status': status,
+        'time_counts': _counts(time_bin, status, TIME_BINS),
+        'space_counts': _counts(space_bin, status, SPACE_BINS ** 2)
+    }
+
+
+def ensure() -> dict:
+    if st.session_state.get('overview') is None:
+        segment_df = st.session_state['segment_df']
+        st.session_state['overview'] = build(segment_df, shared.label_values(segment_df))
+    return st.session_state['overview']
+
+
+def update(segments, fraud):
+    # Move the relabeled segments between status columns of the bins they fall in
+    overview = st.session_state.get('overview')
+    if overview is None:
+        return
+    positions = st.session_state['segment_df']['segment'].searchsorted(np.asarray(segments))
+    old = overview['status'][positions]
+    new = status_codes(fraud)
+    for kind in ['time', 'space']:
+        bins = overview[f'{kind}_bin'][positions]
+        np.subtract.at(overview[f'{kind}_counts'], (bins, old), 1)
+        np.add.at(overview[f'{kind}_counts'], (bins, new), 1)
+    overview['status'][positions] = new
+
+
+def bin_segment(kind: str, index: int):
+    # First unlabeled segment in the bin, or its first segment when it is fully labeled
+    overview = ensure()
+    positions = np.flatnonzero(overview[f'{kind}_bin'] == index)
+    if not len(positions):
+        return None
+    unlabeled = positions[overview['status'][positions] == 0]
+    position = unlabeled[0] if len(unlabeled) else positions[0]
+    return int(st.session_state['segment_df']['segment'].iloc[position])
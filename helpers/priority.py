@@ -0,0 +1,107 @@
+import streamlit as st
+import pandas as pd
+import numpy as np
+from helpers import geo, shared
+
+
+# Risk score per segment in [0, 1], higher means a human should look at it first.
+# Built from the same numbers the stats panel shows, weighted and clipped to [0, 1].
+WEIGHTS = {
+    'speed': 0.5,       # speed from the last valid segment, scaled against an airliner
+    'coverage': 0.2,    # low time coverage
+    'duplicates': 0.15, # share of duplicate locates
+    'apps': 0.15        # number of supply ids
+}
+SPEED_LIMIT_KMH = 900
+
+
+def _valid(fraud: pd.Series) -> np.ndarray:
+    # Unlabeled segments count as valid, the same rule render_stats uses
+    return fraud.to_numpy(dtype=object) != False
+
+
+def _previous_valid(valid: np.ndarray) -> np.ndarray:
+    # Position of the last valid segment strictly before each segment, -1 if none
+    positions = np.where(valid, np.arange(len(valid)), -1)
+    last = np.maximum.accumulate(positions) if len(positions) else positions
+    return np.concatenate([[-1], last[:-1]]) if len(last) else last
+
+
+def last_valid(fraud: pd.Series) -> np.ndarray:
+    return _previous_valid(_valid(fraud))
+
+
+def score_segments(segment_df: pd.DataFrame, fraud: pd.Series, positions: np.ndarray = None) -> np.ndarray:
+    if positions is None:
+        positions = np.arange(len(segment_df))
+    previous = last_valid(fraud)[positions]
+
+    # Speed from the end of the last valid segment to the start of this one
+    speed = np.nan_to_num(geo.hops(segment_df, previous, positions)['kmh'])
+
+    coverage = segment_df['coverage_percent'].to_numpy(dtype='float64')[positions]
+    duplicates = segment_df['locates'].to_numpy(dtype='float64')[positions]
+    rows = segment_df['id'].to_numpy(dtype='float64')[positions]
+    apps = segment_df['supply_id'].to_numpy(dtype='float64')[positions]
+
+    score = (
+        WEIGHTS['speed'] * np.clip(speed / SPEED_LIMIT_KMH, 0, 1) +
+        WEIGHTS['coverage'] * np.clip(1 - np.nan_to_num(coverage, nan=100) / 100, 0, 1) +
+        WEIGHTS['duplicates'] * np.clip(np.nan_to_num(duplicates / (duplicates + rows)), 0, 1) +
+        WEIGHTS['apps'] * np.clip((np.nan_to_num(apps, nan=1) - 1) / 3, 0, 1)
+    )
+
+    # 742 is the source of truth and already marked good
+    score[segment_df['has_742'].to_numpy()[positions] == 1] = 0
+    return score
+
+
+def ensure_scores() -> np.ndarray:
+    if st.session_state.get('scores') is None:
+        segment_df = st.session_state['segment_df']
+        st.session_state['scores'] = score_segments(segment_df, shared.label_values(segment_df))
+    return st.session_state['scores']
+
+
+def rescore(first: int, last: int):
+    # Only segments between a relabeled span and the next valid segment change their
+    # last valid segment, everything else keeps its score
+    if st.session_state.get('scores') is None:
+        return
+    segment_df = st.session_state['segment_df']
+    fraud = shared.label_values(segment_df)
+    valid = _valid(fraud)
+
+    segments = segment_df['segment'].to_numpy()
+    start = np.searchsorted(segments, first)
+    end = np.searchsorted(segments, last, side='right')
+    following = np.flatnonzero(valid[end:])
+    stop = end + following[0] + 1 if len(following) else len(segments)
+
+    positions = np.arange(start, stop)
+    st.session_state['scores'][positions] = score_segments(segment_df, fraud, positions)
+
+
+def unlabeled_mask() -> np.ndarray:
+    return shared.label_values(st.session_state['segment_df']).isna().to_numpy()
+
+
+def highest_risk_segment():
+    scores = ensure_scores()
+    unlabeled = unlabeled_mask()
+    if not unlabeled.any():
+        return None
+    position = np.flatnonzero(unlabeled)[np.argmax(scores[unlabeled])]
+    return int(st.session_state['segment_df']['segment'].iloc[position])
+
+
+def low_risk_run(confidence: float, segment: int):
+    # Last segment of the run of unlabeled segments we are at least `confidence` sure are good
+    # starting at `segment`, None if `segment` itself isn't one
+    scores = ensure_scores()
+    mask = unlabeled_mask() & (1 - scores >= confidence)
+    segments = st.session_state['segment_df']['segment'].to_numpy()
+    start = np.searchsorted(segments, segment)
+    stops = np.flatnonzero(~mask[start:])
+    end = start + stops[0] if len(stops) else len(segments)
+    return int(segments[end - 1]) if end > start else None
@@ -0,0 +1,70 @@
+import threading
+import weakref
+import streamlit as st
+import pandas as pd
+
+
+# Process wide store of loaded device frames keyed by (device, truncation, minutes, km_threshold).
+# Sessions only hold references to these frames and never write to them, their own labels live
+# in st.session_state['labels'] ({segment: is_valid}) and are laid over the frames when read.
+# Entries are held weakly, each session keeps its entry alive in st.session_state['shared'], so a
+# device's frames are freed as soon as no session has it loaded.
+
+
+class _Entry(dict):
+    # plain dicts can't be weakly referenced
+    pass
+
+
+_frames = weakref.WeakValueDictionary()
+_lock = threading.Lock()
+
+
+def device_key() -> tuple:
+    return (
+        st.session_state['device_id'].lower(),
+        int(st.session_state['truncation']),
+        int(st.session_state['minutes']),
+        int(st.session_state['km_threshold'])
+    )
+
+
+def get(key: tuple, version=None):
+    # Only hand out frames built from the same version of the s3 file
+    with _lock:
+        entry = _frames.get(key)
+    if entry is None or entry['version'] != version:
+        return None
+    return entry
+
+
+def put(key: tuple, version, df: pd.DataFrame, segment_df: pd.DataFrame) -> dict:
+    entry = _Entry(version=version, df=df, segment_df=segment_df)
+    with _lock:
+        _frames[key] = entry
+    return entry
+
+
+def devices() -> int:
+    # devices currently loaded by at least one session
+    return len(_frames)
+
+
+def label_values(frame: pd.DataFrame) -> pd.Series:
+    # The frame's fraud column with this session's labels applied
+    labels = st.session_state.get('labels', {})
+    if not labels:
+        return frame['fraud']
+    fraud = frame['fraud'].astype(object)
+    mask = frame['segment'].isin(labels.keys())
+    fraud[mask] = frame.loc[mask, 'segment'].map(labels)
+    return fraud
+
+
+def labeled(frame: pd.DataFrame) -> pd.DataFrame:
+    # Shallow copy so only the fraud column is new, the shared frame is left untouched
+    if not st.session_state.get('labels'):
+        return frame
+    view = frame.copy(deep=False)
+    view['fraud'] = label_values(frame)
+    return view
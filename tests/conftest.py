@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+duckdb = pytest.importorskip('duckdb')
+
+
+# DuckDB stand-in for the warehouse: the two source tables filled with a synthetic device and
+# macros for the Snowflake functions the extraction SQL uses. trunc works on the decimal value
+# like Snowflake's, a plain float multiply would turn 40.1234 into 40.1233.
+DEVICE_ID = '0a1b2c3d-0000-0000-0000-000000000001'
+
+MACROS = """
+create macro md5_hex(x) as md5(x);
+create macro time_slice(ts, m, unit) as to_timestamp(floor(epoch(ts) / (m * 60)) * (m * 60));
+create macro sf_trunc(x, n) as trunc(cast(x as decimal(18, 8)) * cast(pow(10, n) as decimal(18, 0))) / pow(10, n);
+create macro haversine(lat1, lon1, lat2, lon2) as 2 * 6371 * asin(sqrt(
+    pow(sin(radians(lat2 - lat1) / 2), 2) + cos(radians(lat1)) * cos(radians(lat2)) * pow(sin(radians(lon2 - lon1) / 2), 2)
+));
+"""
+
+
+def _locates(rng, n: int) -> pd.DataFrame:
+    # A slow random walk at 4 decimal places that often stands still, with the odd long jump,
+    # so truncation and time buckets produce duplicates and the km threshold splits segments
+    steps = rng.normal(0, 0.002, (2, n)) * (rng.random(n) > 0.4) + rng.normal(0, 0.5, (2, n)) * (rng.random(n) > 0.97)
+    return pd.DataFrame({
+        'idfa': DEVICE_ID.upper(),
+        'timestamp': pd.Timestamp('2024-01-01') + pd.to_timedelta(np.sort(rng.integers(0, 86400 * 2, n)), unit='s'),
+        'latitude': np.round(40 + np.cumsum(steps[0]), 4),
+        'longitude': np.round(-73 + np.cumsum(steps[1]), 4),
+        'supply_id': rng.choice(['1', '2', '742'], n, p=[0.6, 0.39, 0.01])
+    })
+
+
+def _to_duckdb(sql: str) -> str:
+    # snowflake's trunc(x, n) and unit spellings
+    return (
+        sql.replace(' trunc(', ' sf_trunc(')
+        .replace('(trunc(', '(sf_trunc(')
+        .replace("date_trunc('mins'", "date_trunc('minute'")
+        .replace("datediff('minutes'", "datediff('minute'")
+    )
+
+
+@pytest.fixture(scope='session')
+def warehouse():
+    # Returns run(sql) -> rows, the same shape snowflake_runner() gives
+    rng = np.random.default_rng(1)
+    # one walk split across both tables, like a device seen by both feeds
+    locates = _locates(rng, 6000)
+    in_h4 = rng.random(len(locates)) < 0.5
+    h4 = locates[in_h4]
+    purge = locates[~in_h4]
+
+    con = duckdb.connect()
+    con.sql("attach ':memory:' as singularity")
+    con.sql('create schema singularity.public')
+    con.sql(MACROS)
+    con.sql('create table singularity.public.h4_maid_clustered as select * from h4')
+    con.sql('create table singularity.public.locations_purge as select * from purge')
+
+    def _run(sql: str):
+        return con.sql(_to_duckdb(sql)).fetchall()
+
+    yield _run
+    con.close()
+
+
+@pytest.fixture
+def session():
+    # streamlit's bare mode session state, emptied around each test so helpers see a fresh session
+    import streamlit as st
+    st.session_state.clear()
+    yield st.session_state
+    st.session_state.clear()
@@ -0,0 +1,85 @@
+import os
+import pandas as pd
+import pytest
+from helpers.dataset import DTYPES, TIME_COLUMNS, build, partition_path
+from helpers.loadtest import synthetic_device
+
+
+PARAMS = {'truncation': 4, 'minutes': 5, 'km_threshold': 10}
+DEVICES = [f'0a1b2c3d-0000-0000-0000-00000000000{i}' for i in range(3)]
+
+
+def _device_path(source, device_id: str):
+    return source / 'raw_input' / str(PARAMS['truncation']) / str(PARAMS['minutes']) / str(PARAMS['km_threshold']) / f'{device_id}.csv'
+
+
+def _write_device(source, device_id: str, labeled: dict, seed: int = 0) -> str:
+    # labeled maps segment -> fraud, everything else is left unlabeled
+    df = synthetic_device(device_id, segments=20, locates_per_segment=5, seed=seed)
+    df['fraud'] = df['segment'].map(labeled)
+    path = _device_path(source, device_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    df.to_csv(path, index=False)
+    return df
+
+
+def _partition(out, device_id: str) -> str:
+    return partition_path(str(out), {**PARAMS, 'device_id': device_id})
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    source, out = tmp_path / 'bucket', tmp_path / 'training'
+    frames = {device_id: _write_device(source, device_id, {0: True, 3: False, 7: True}, seed=i) for i, device_id in enumerate(DEVICES)}
+    return source, out, frames
+
+
+def test_keeps_labeled_rows_with_dtypes(dirs):
+    source, out, frames = dirs
+    summary = build(str(source), str(out), workers=2)
+    assert summary['processed'] == len(DEVICES) and summary['errors'] == 0
+
+    assert summary['rows'] == sum(raw['fraud'].notna().sum() for raw in frames.values())
+    for device_id, raw in frames.items():
+        got = pd.read_parquet(_partition(out, device_id))
+        labeled = raw[raw['fraud'].notna()]
+        assert len(got) == len(labeled) > 0
+        assert got['segment'].tolist() == labeled['segment'].tolist()
+        assert got['fraud'].tolist() == labeled['fraud'].astype(bool).tolist()
+        assert (got['device_id'] == device_id).all()
+        for column, dtype in DTYPES.items():
+            assert str(got[column].dtype) == dtype, column
+        for column in TIME_COLUMNS:
+            assert str(got[column].dtype) == 'datetime64[ns, UTC]', column
+
+
+def test_second_run_skips_unchanged(dirs):
+    source, out, _ = dirs
+    build(str(source), str(out), workers=2)
+    summary = build(str(source), str(out), workers=2)
+    assert summary['skipped'] == len(DEVICES)
+    assert summary['processed'] == summary['removed'] == summary['rows'] == 0
+
+
+def test_edited_device_is_reread(dirs):
+    source, out, _ = dirs
+    build(str(source), str(out), workers=2)
+    edited = _write_device(source, DEVICES[1], {0: True, 1: True, 2: False, 3: False}, seed=1)
+
+    summary = build(str(source), str(out), workers=2)
+    assert summary['processed'] == 1 and summary['skipped'] == len(DEVICES) - 1
+    got = pd.read_parquet(_partition(out, DEVICES[1]))
+    assert sorted(got['segment'].unique()) == [0, 1, 2, 3]
+    assert summary['rows'] == len(got) == edited['fraud'].notna().sum()
+
+
+def test_deleted_device_partition_is_removed(dirs):
+    source, out, _ = dirs
+    build(str(source), str(out), workers=2)
+    assert os.path.exists(_partition(out, DEVICES[2]))
+    os.remove(_device_path(source, DEVICES[2]))
+
+    summary = build(str(source), str(out), workers=2)
+    assert summary['removed'] == 1 and summary['skipped'] == len(DEVICES) - 1
+    assert not os.path.exists(_partition(out, DEVICES[2]))
+    assert os.path.exists(_partition(out, DEVICES[0]))
@@ -0,0 +1,22 @@
+import pytest
+from helpers.dedup import apply_duplicates
+from helpers.extract import locates_sql, locates_frame, group_segments
+from conftest import DEVICE_ID
+
+
+KM_THRESHOLD = 2
+LOADED = {'minutes': 5, 'truncation': 4}
+
+
+@pytest.mark.parametrize('minutes,truncation', [(5, 4), (1, 4), (30, 3), (60, 5), (1, 6)])
+def test_local_duplicates_match_sql(warehouse, minutes, truncation):
+    # Recompute from a device loaded with one set of parameters and compare against the
+    # warehouse queried directly with the new ones
+    df = locates_frame(warehouse(locates_sql(DEVICE_ID, LOADED['minutes'], LOADED['truncation'], KM_THRESHOLD)))
+    segment_df = group_segments(df)
+    apply_duplicates(df, segment_df, minutes, truncation)
+
+    expected = group_segments(locates_frame(warehouse(locates_sql(DEVICE_ID, minutes, truncation, KM_THRESHOLD))))
+    assert segment_df['segment'].tolist() == expected['segment'].tolist()
+    assert segment_df['locates'].tolist() == expected['locates'].astype('int64').tolist()
+    assert (expected['locates'] > 0).any()
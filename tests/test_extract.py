@@ -0,0 +1,22 @@
+import numpy as np
+import pandas as pd
+import pytest
+from helpers.extract import locates_sql, segments_sql, locates_frame, segments_frame, group_segments
+from conftest import DEVICE_ID
+
+
+@pytest.mark.parametrize('minutes,truncation,km_threshold', [(5, 4, 2), (1, 3, 10), (60, 6, 1)])
+def test_segments_sql_matches_group_segments(warehouse, minutes, truncation, km_threshold):
+    # Summary first must give the same segment frame as grouping the raw locates locally
+    expected = group_segments(locates_frame(warehouse(locates_sql(DEVICE_ID, minutes, truncation, km_threshold))))
+    got = segments_frame(warehouse(segments_sql(DEVICE_ID, minutes, truncation, km_threshold)))
+
+    assert list(got.columns) == list(expected.columns)
+    assert len(got) == len(expected) > 1
+    for column in expected.columns:
+        if column == 'fraud':
+            assert (got[column] == True).tolist() == (expected[column] == True).tolist()
+        elif expected[column].dtype.kind in 'fi':
+            np.testing.assert_allclose(got[column].astype('float64'), expected[column].astype('float64'), equal_nan=True, err_msg=column)
+        else:
+            assert (pd.Series(got[column]) == pd.Series(expected[column])).all(), column
@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+from haversine import haversine_vector
+from helpers.geo import MIN_MINUTES, haversine, speed_kmh, minutes_between, hops, segment_gaps
+
+
+def _segments(n: int) -> pd.DataFrame:
+    start = pd.Timestamp('2024-01-01', tz='UTC') + pd.to_timedelta(np.arange(n) * 30, unit='m')
+    return pd.DataFrame({
+        'start_lat': 40 + np.arange(n, dtype='float64'),
+        'start_lon': -100 + np.arange(n, dtype='float64'),
+        'end_lat': 40.5 + np.arange(n, dtype='float64'),
+        'end_lon': -99.5 + np.arange(n, dtype='float64'),
+        'start_time': start,
+        'end_time': start + pd.Timedelta(minutes=10)
+    })
+
+
+def test_haversine_matches_package():
+    rng = np.random.default_rng(0)
+    lat1, lat2 = rng.uniform(-90, 90, (2, 1000))
+    lon1, lon2 = rng.uniform(-180, 180, (2, 1000))
+    expected = haversine_vector(np.column_stack([lat1, lon1]), np.column_stack([lat2, lon2]))
+    np.testing.assert_allclose(haversine(lat1, lon1, lat2, lon2), expected, rtol=1e-9, atol=1e-6)
+    assert haversine(10, 20, 10, 20) == 0
+
+
+def test_speed_kmh_short_and_missing_gaps():
+    km = np.full(6, 6.0)
+    got = speed_kmh(km, [0, -5, 0.25, np.nan, 1, 30])
+    floor = 6.0 / (MIN_MINUTES / 60)
+    np.testing.assert_allclose(got[[0, 1, 2, 4]], floor)
+    assert np.isnan(got[3])
+    assert got[5] == 12.0
+
+
+def test_minutes_between_nat():
+    ends = pd.to_datetime(['2024-01-01 00:00', None, '2024-01-01 00:00'], utc=True)
+    starts = pd.to_datetime(['2024-01-01 00:30', '2024-01-01 01:00', None], utc=True)
+    got = minutes_between(ends, starts)
+    assert got[0] == 30
+    assert np.isnan(got[1]) and np.isnan(got[2])
+
+
+def test_hops_without_previous():
+    segment_df = _segments(4)
+    got = hops(segment_df, previous=[-1, 0, -1, 1], positions=[0, 1, 2, 3])
+    for name in ['km', 'minutes', 'kmh', 'bearing']:
+        assert np.isnan(got[name][[0, 2]]).all(), name
+        assert not np.isnan(got[name][[1, 3]]).any(), name
+
+    # segment 1 follows segment 0 directly, segment 3 skips back to segment 1
+    assert got['minutes'][1] == 20 and got['minutes'][3] == 50
+    np.testing.assert_allclose(got['km'][[1, 3]], haversine([40.5, 41.5], [-99.5, -98.5], [41, 43], [-99, -97]))
+
+    empty = hops(segment_df, previous=[-1, -1], positions=[0, 1])
+    assert all(np.isnan(values).all() and len(values) == 2 for values in empty.values())
+
+
+def test_segment_gaps_small_frames():
+    np.testing.assert_array_equal(segment_gaps(_segments(1)), [0.0])
+    assert len(segment_gaps(_segments(0))) == 0
+
+    gaps = segment_gaps(_segments(3))
+    assert gaps[0] == 0 and len(gaps) == 3
+    np.testing.assert_allclose(gaps[1:], haversine([40.5, 41.5], [-99.5, -98.5], [41, 42], [-99, -98]))
@@ -0,0 +1,11 @@
+from helpers.importtime import measure
+
+
+# Generous on purpose, app itself takes a few ms, a regression pulls in a heavy dependency
+BUDGET_MS = 1000
+
+
+def test_app_import_defers_heavy_dependencies():
+    report = measure()
+    assert report['loaded_deferred'] == []
+    assert report['app_ms'] < BUDGET_MS, report['heaviest']
@@ -0,0 +1,28 @@
+import numpy as np
+from helpers import overview, shared
+from helpers.extract import group_segments
+from helpers.loadtest import synthetic_device
+
+
+def test_update_matches_build(session):
+    # Incremental updates after single and range labels, including relabels, must leave the
+    # same counts as building the overview from the labels again
+    segment_df = group_segments(synthetic_device('0a1b2c3d-0000-0000-0000-000000000001', segments=400, locates_per_segment=3))
+    session['segment_df'] = segment_df
+    session['labels'] = {}
+    session['overview'] = None
+    overview.ensure()
+
+    rng = np.random.default_rng(0)
+    for i in range(300):
+        first = int(rng.integers(0, len(segment_df)))
+        last = first if i % 2 else min(first + int(rng.integers(1, 20)), len(segment_df) - 1)
+        segments = dict.fromkeys(range(first, last + 1), bool(rng.random() < 0.5))
+        session['labels'].update(segments)
+        overview.update(list(segments.keys()), list(segments.values()))
+
+    expected = overview.build(segment_df, shared.label_values(segment_df))
+    got = session['overview']
+    for key in ['status', 'time_counts', 'space_counts']:
+        np.testing.assert_array_equal(got[key], expected[key], err_msg=key)
+    assert got['status'].min() == 0 and got['status'].max() == 2
@@ -0,0 +1,51 @@
+import numpy as np
+from helpers import priority, shared
+from helpers.extract import group_segments
+from helpers.loadtest import synthetic_device
+
+
+def _segment_df(segments: int = 300):
+    return group_segments(synthetic_device('0a1b2c3d-0000-0000-0000-000000000001', segments=segments, locates_per_segment=3))
+
+
+def test_rescore_matches_full_score(session):
+    # Labeling ranges the way label_segments does, rescoring only when validity changes, must
+    # leave the same scores as scoring every segment again
+    segment_df = _segment_df()
+    session['segment_df'] = segment_df
+    session['labels'] = {}
+    session['scores'] = None
+    priority.ensure_scores()
+
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        first = int(rng.integers(0, len(segment_df)))
+        last = min(first + int(rng.integers(0, 15)), len(segment_df) - 1)
+        value = bool(rng.random() < 0.6)
+        segments = dict.fromkeys(range(first, last + 1), value)
+
+        before = shared.label_values(segment_df[segment_df['segment'].isin(segments.keys())])
+        changes_validity = False in segments.values() or (before == False).any()
+        session['labels'].update(segments)
+        if changes_validity:
+            priority.rescore(first, last)
+
+        expected = priority.score_segments(segment_df, shared.label_values(segment_df))
+        np.testing.assert_allclose(session['scores'], expected)
+
+    assert (shared.label_values(segment_df) == False).sum() > 10
+
+
+def test_low_risk_run(session):
+    segment_df = _segment_df(20)
+    session['segment_df'] = segment_df
+    session['labels'] = {}
+    session['scores'] = np.array([0.0] * 5 + [0.9] + [0.0] * 14)
+
+    assert priority.low_risk_run(0.95, 0) == 4
+    assert priority.low_risk_run(0.95, 5) is None
+    assert priority.low_risk_run(0.95, 6) == 19
+
+    # labeled segments end the run as well
+    session['labels'][10] = True
+    assert priority.low_risk_run(0.95, 6) == 9